@@ -1,31 +1,72 @@
+import time
+_import_start = time.perf_counter()
 import numpy as np
 import pandas as pd
-import yfinance as yf
-from sklearn.preprocessing import MinMaxScaler
-from keras.models import Sequential
-from keras.layers import LSTM, Dense, Dropout, Input
-from prophet import Prophet
 import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 import datetime
 import requests
-from pymongo import MongoClient
 import os
+import sys
+import re
+import json
+import hashlib
+import heapq
+import sqlite3
+import argparse
+import importlib
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
 from dotenv import load_dotenv
-from tensorflow.keras.layers import MultiHeadAttention, LayerNormalization, Add
-from tensorflow.keras.optimizers import Adam
-from tensorflow.keras.models import Model
+try:
+    import resource
+except ImportError:  # Windows 沒有 resource 模組
+    resource = None
+# TensorFlow / Keras、Prophet、scikit-learn、yfinance 與 pymongo 載入較慢，改由 lazy_import 在第一次使用時才匯入
 
 # 加載 .env 文件
 load_dotenv()
 
+# 設定解析：格式錯誤時先使用默認值並記錄下來，由 validate_config 在開始下載與訓練之前一次回報
+config_errors = []
+
+
+def env_int(name, default):
+    value = os.getenv(name, "").strip()
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        config_errors.append(f"{name} 必須是整數: {value!r}")
+        return default
+
+
+def env_float(name, default):
+    value = os.getenv(name, "").strip()
+    if not value:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        config_errors.append(f"{name} 必須是數字: {value!r}")
+        return default
+
+
+def env_list(name):
+    return [item.strip() for item in os.getenv(name, "").split(",") if item.strip()]
+
+
 # Email 設置
 smtp_server = os.getenv("SMTP_SERVER")
-port = int(os.getenv("SMTP_PORT"))
+port = env_int("SMTP_PORT", 465)
 sender_email = os.getenv("SENDER_EMAIL")
 password = os.getenv("EMAIL_PASSWORD")
-to_emails = os.getenv("TO_EMAILS").split(",")
+to_emails = env_list("TO_EMAILS")
 
 # Telegram 設置
 telegram_bot_token = os.getenv("TELEGRAM_BOT_TOKEN")
@@ -37,6 +78,12 @@ db_name = "stock_predictions"
 
 discord_webhook_url = os.getenv("DISCORD_WEBHOOK_URL")
 
+# 通知重試設置；TELEGRAM_API_URL 與 SMTP_USE_SSL 可用於指向本地測試伺服器
+telegram_api_url = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")
+smtp_use_ssl = os.getenv("SMTP_USE_SSL", "true").lower() == "true"
+notify_max_retries = env_int("NOTIFY_MAX_RETRIES", 3)
+notify_backoff_seconds = env_float("NOTIFY_BACKOFF_SECONDS", 1)
+
 # 是否使用 Transformer
 use_transformer = os.getenv("USE_TRANSFORMER", "false").lower() == "true"
 transformer_period = os.getenv("TRANSFORMER_PERIOD", "1y")  # 默認 1 年數據
@@ -44,32 +91,376 @@ transformer_period = os.getenv("TRANSFORMER_PERIOD", "1y")  # 默認 1 年數據
 # 是否使用 Prophet
 use_prophet = os.getenv("USE_PROPHET", "false").lower() == "true"
 
+# 是否將各模型的預測合併為 Ensemble 排名：rank 為各模型百分位排名的加權平均，weighted 為潛力的加權平均
+# ENSEMBLE_WEIGHTS 格式為 lstm:1,transformer:1,prophet:1，未列出的模型權重為 1
+use_ensemble = os.getenv("ENSEMBLE", "false").lower() == "true"
+ensemble_method = os.getenv("ENSEMBLE_METHOD", "rank").lower()
+
+
+def parse_weights(name):
+    weights = {}
+    for item in env_list(name):
+        model, _, value = item.partition(":")
+        try:
+            weights[model.strip()] = float(value)
+        except ValueError:
+            config_errors.append(f"{name} 格式應為 model:weight: {item!r}")
+    return weights
+
+
+ensemble_weights = parse_weights("ENSEMBLE_WEIGHTS")
+
+# 是否以整個指數共用一個 LSTM / Transformer 模型，以及股票代碼 Embedding 維度（0 表示不使用）
+pooled_training = os.getenv("POOLED_TRAINING", "false").lower() == "true"
+pooled_embedding_dim = env_int("POOLED_EMBEDDING_DIM", 4)
+
+# 自適應訓練（默認關閉，維持固定 10 個 epoch）：以最近的 VALIDATION_SPLIT 比例樣本作為驗證集提前停止
+# （pooled 模式為每檔股票各自最近的樣本），
+# 最多 MAX_EPOCHS 個 epoch，batch size 依樣本數調整
+adaptive_training = os.getenv("ADAPTIVE_TRAINING", "false").lower() == "true"
+max_epochs = env_int("MAX_EPOCHS", 50)
+early_stopping_patience = env_int("EARLY_STOPPING_PATIENCE", 3)
+validation_split = env_float("VALIDATION_SPLIT", 0.1)
+
+# 訓練時間預算：單次訓練的秒數上限，以及整次執行的截止秒數（0 表示不限制）
+# 接近截止時間時後面的股票略過 Transformer，超過後每次訓練只跑一個 epoch
+fit_time_budget_seconds = env_float("FIT_TIME_BUDGET_SECONDS", 0)
+run_deadline_seconds = env_float("RUN_DEADLINE_SECONDS", 0)
+
+# LSTM / Transformer 在 OHLCV 之外額外使用的衍生特徵，逗號分隔，可選 return、log_volume、range（默認不使用）
+extra_features = env_list("EXTRA_FEATURES")
+
+# 模型檢查點目錄（未設置時每次都從頭訓練）、微調的 epoch 數與完整重新訓練的間隔天數
+model_dir = os.getenv("MODEL_DIR", "")
+finetune_epochs = env_int("FINETUNE_EPOCHS", 2)
+model_max_age_days = env_int("MODEL_MAX_AGE_DAYS", 7)
+
+# 推論後端：keras 或 tflite；tflite 可選 none / float16 / int8 量化，與 Keras 預測（標準化後）差異超過容許值時改用 Keras
+# 只有常駐服務會轉換並保存 TFLite 模型，批次執行只沿用與檢查點版本相同的轉換結果
+inference_backend = os.getenv("INFERENCE_BACKEND", "keras").lower()
+tflite_quantization = os.getenv("TFLITE_QUANTIZATION", "none").lower()
+tflite_tolerance = env_float("TFLITE_TOLERANCE", 0.005)
+
+# 並行運算設置：運算進程數與每個進程的 TensorFlow 執行緒數（0 表示自動分配）
+parallel_workers = env_int("PARALLEL_WORKERS", 1)
+tf_threads_per_worker = env_int("TF_THREADS_PER_WORKER", 0)
+
+# 工作排程：每個 (股票, 模型) 的實測耗時保存在此檔案中改進下次的估計（設為空字串可停用），
+# 所有運算進程合計的記憶體預算 (MB)，0 表示不限制
+cost_model_file = os.getenv("COST_MODEL_FILE", ".cost_model.json")
+run_memory_budget_mb = env_float("RUN_MEMORY_BUDGET_MB", 0)
+
+# 執行檢查點檔案（設為空字串可停用），中斷後重新執行會從最後完成的股票繼續
+run_checkpoint_file = os.getenv("RUN_CHECKPOINT_FILE", ".run_checkpoint.jsonl")
+
+# 執行指標輸出檔案（JSON lines，設為空字串可停用）與 Keras fit/predict 的輸出等級（0 為靜默）
+metrics_file = os.getenv("METRICS_FILE", "metrics.jsonl")
+keras_verbose = env_int("KERAS_VERBOSE", 1)
+
+# 預測歷史：設置 MONGO_URI 時寫入 MongoDB，否則寫入本地 SQLite 檔案（HISTORY_DB 設為空字串可停用），每批寫入的行數
+history_db = os.getenv("HISTORY_DB", "prediction_history.sqlite3")
+history_batch_size = env_int("HISTORY_BATCH_SIZE", 500)
+
+# 本地價格快取目錄（設為空字串可停用快取），以及快取的股票多久後重新下載最新交易日（秒），盤中未收盤的數據會被覆蓋
+price_cache_dir = os.getenv("PRICE_CACHE_DIR", ".price_cache")
+price_cache_max_age = env_float("PRICE_CACHE_MAX_AGE_SECONDS", 3600)
+
+
+# 執行指標
+def peak_rss_mb(children=False):
+    """返回目前進程（或已結束的子進程）的 peak RSS，單位 MB"""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # Linux 的 ru_maxrss 單位為 KB，macOS 為 bytes
+    return round(usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024), 2)
+
+
+def current_rss_mb():
+    """返回目前進程當下的 RSS，單位 MB；peak RSS 只會上升，量測單一階段的記憶體需用此值，沒有 /proc 的平台返回 None"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return round(pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024), 2)
+
+
+class RunMetrics:
+    """
+    記錄執行期間的耗時區段 (span) 與計數器，main 結束時以 JSON lines 寫入 METRICS_FILE
+    巢狀的 span 會繼承外層的標籤，例如 fit 區段自動帶有所屬的 ticker
+    """
+
+    def __init__(self):
+        self.spans = []
+        self.counters = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, **labels):
+        parent = getattr(self._local, "labels", {})
+        labels = {**parent, **labels}
+        self._local.labels = labels
+        start = time.perf_counter()
+        status = "ok"
+        try:
+            yield labels  # 呼叫端可在區段內補充標籤，例如下載的位元組數
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            self._local.labels = parent
+            self.record(name, time.perf_counter() - start, status=status, **labels)
+
+    def record(self, name, duration, **labels):
+        with self._lock:
+            self.spans.append({"name": name, "duration_s": round(duration, 6), **labels})
+
+    def incr(self, name, value=1, **labels):
+        key = json.dumps([name, labels], sort_keys=True, ensure_ascii=False)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def drain(self):
+        """取出並清空目前記錄，用於將子進程的指標傳回主進程"""
+        with self._lock:
+            snapshot = {"spans": self.spans, "counters": self.counters}
+            self.spans, self.counters = [], {}
+        return snapshot
+
+    def merge(self, snapshot):
+        with self._lock:
+            self.spans.extend(snapshot["spans"])
+            for key, value in snapshot["counters"].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    def summary(self):
+        """依 (name, model) 彙總 span 的次數、總耗時與最大耗時"""
+        # 其他執行緒可能同時記錄指標，先在鎖內取得快照再彙總
+        with self._lock:
+            spans, counter_items = list(self.spans), list(self.counters.items())
+        totals = {}
+        for span in spans:
+            key = (span["name"], span.get("model"))
+            total = totals.setdefault(key, {"name": key[0], "model": key[1], "count": 0, "total_s": 0.0, "max_s": 0.0})
+            total["count"] += 1
+            total["total_s"] = round(total["total_s"] + span["duration_s"], 6)
+            total["max_s"] = max(total["max_s"], span["duration_s"])
+        counters = [{"name": json.loads(key)[0], **json.loads(key)[1], "value": value} for key, value in counter_items]
+        return {
+            "spans": list(totals.values()),
+            "counters": counters,
+            "peak_rss_mb": peak_rss_mb(),
+            "peak_rss_children_mb": peak_rss_mb(children=True),
+        }
+
+    def write(self, path, **extra):
+        """追加寫入所有 span 與一筆彙總記錄，每一行都帶有 run_id"""
+        run_id = datetime.datetime.now().isoformat(timespec="seconds")
+        with self._lock:
+            spans = list(self.spans)
+        with open(path, "a", encoding="utf-8") as f:
+            for span in spans:
+                f.write(json.dumps({"run_id": run_id, "type": "span", **span}, ensure_ascii=False) + "\n")
+            f.write(json.dumps({"run_id": run_id, "type": "summary", **extra, **self.summary()}, ensure_ascii=False) + "\n")
+        print(f"執行指標已寫入 {path}")
+
+
+metrics = RunMetrics()
+
+
+def lazy_import(module):
+    """匯入較重的套件並返回模組，第一次匯入時將耗時記錄為 import 區段"""
+    if module not in sys.modules:
+        start = time.perf_counter()
+        importlib.import_module(module)
+        metrics.record("import", time.perf_counter() - start, module=module)
+    return sys.modules[module]
+
+
+_mongo_client = None
+
+
+def get_mongo_client():
+    """返回共用的 MongoClient（內建連接池），整個執行期間只建立一次"""
+    global _mongo_client
+    if _mongo_client is None:
+        _mongo_client = lazy_import("pymongo").MongoClient(mongo_uri)
+    return _mongo_client
+
 
 def save_to_mongodb(index_name, stock_predictions):
     """
     將股票預測結果存入 MongoDB
     :param index_name: 指數名稱
     :param stock_predictions: 預測結果 (dict)
+    失敗時拋出例外，由通知佇列記錄，指數不會被標記為已發送
     """
-    try:
-        client = MongoClient(mongo_uri)
-        db = client[db_name]
-        collection = db["predictions"]
-
-        # 設置要寫入的文件格式
-        record = {
-            "index": index_name,
-            "timestamp": datetime.datetime.now(),
-            "predictions": stock_predictions
-        }
+    db = get_mongo_client()[db_name]
+    collection = db["predictions"]
+
+    # 設置要寫入的文件格式
+    record = {
+        "index": index_name,
+        "timestamp": datetime.datetime.now(),
+        "predictions": stock_predictions
+    }
 
-        # 寫入 MongoDB
-        collection.insert_one(record)
-        print(f"成功將 {index_name} 結果寫入 MongoDB")
-    except Exception as e:
-        print(f"⚠️ 寫入 MongoDB 失敗: {str(e)}")
-    finally:
-        client.close()
+    # 寫入 MongoDB
+    collection.insert_one(record)
+    print(f"成功將 {index_name} 結果寫入 MongoDB")
+
+
+# 預測歷史：每個 (run, index, ticker, model) 一行，依 ticker / date 建立索引，查詢單一股票的走勢不必掃描整個集合
+HISTORY_TABLE = "prediction_history"
+HISTORY_FIELDS = ("run_id", "date", "index_name", "ticker", "model", "potential", "current_price", "predicted_price")
+HISTORY_KEY = ("run_id", "index_name", "ticker", "model")
+_history_db = None
+_history_indexes_ready = False
+
+
+def get_history_db():
+    """返回共用的 SQLite 連線（MONGO_URI 未設置時使用），第一次使用時建立資料表與索引"""
+    global _history_db
+    if _history_db is None:
+        _history_db = sqlite3.connect(history_db, check_same_thread=False)
+        _history_db.executescript(f"""
+            CREATE TABLE IF NOT EXISTS {HISTORY_TABLE} (
+                run_id TEXT NOT NULL,
+                date TEXT NOT NULL,
+                index_name TEXT NOT NULL,
+                ticker TEXT NOT NULL,
+                model TEXT NOT NULL,
+                potential REAL,
+                current_price REAL,
+                predicted_price REAL,
+                PRIMARY KEY ({", ".join(HISTORY_KEY)})
+            );
+            CREATE INDEX IF NOT EXISTS idx_history_ticker_date ON {HISTORY_TABLE} (ticker, model, date);
+            CREATE INDEX IF NOT EXISTS idx_history_date ON {HISTORY_TABLE} (date);
+        """)
+    return _history_db
+
+
+def get_history_collection():
+    """返回 MongoDB 的預測歷史集合，第一次使用時建立索引"""
+    global _history_indexes_ready
+    collection = get_mongo_client()[db_name][HISTORY_TABLE]
+    if not _history_indexes_ready:
+        collection.create_index([(field, 1) for field in HISTORY_KEY], unique=True)
+        collection.create_index([("ticker", 1), ("model", 1), ("date", 1)])
+        collection.create_index([("date", 1)])
+        _history_indexes_ready = True
+    return collection
+
+
+def history_enabled():
+    return bool(mongo_uri or history_db)
+
+
+def write_prediction_history(rows):
+    """
+    批次寫入預測歷史，同一 (run, index, ticker, model) 重複寫入時覆蓋舊值，因此從檢查點續跑不會產生重複的行
+    :param rows: [dict]，欄位為 HISTORY_FIELDS
+    """
+    if not rows:
+        return
+    if mongo_uri:
+        replace_one = lazy_import("pymongo").ReplaceOne
+        get_history_collection().bulk_write(
+            [replace_one({field: row[field] for field in HISTORY_KEY}, row, upsert=True) for row in rows],
+            ordered=False,
+        )
+    else:
+        with get_history_db() as conn:
+            conn.executemany(
+                f"INSERT OR REPLACE INTO {HISTORY_TABLE} ({', '.join(HISTORY_FIELDS)}) "
+                f"VALUES ({', '.join('?' * len(HISTORY_FIELDS))})",
+                [tuple(row[field] for field in HISTORY_FIELDS) for row in rows],
+            )
+    print(f"已寫入 {len(rows)} 筆預測歷史")
+
+
+def load_prediction_history(ticker=None, model=None, index_name=None, start=None, end=None):
+    """
+    查詢預測歷史
+    :param start: 起始日期 'YYYY-MM-DD'（包含）
+    :param end: 結束日期 'YYYY-MM-DD'（包含）
+    :return: 依 date、run_id 排序的 DataFrame，欄位為 HISTORY_FIELDS
+    """
+    filters = {field: value for field, value in (("ticker", ticker), ("model", model), ("index_name", index_name))
+               if value is not None}
+    if mongo_uri:
+        query = dict(filters)
+        date_range = {op: value for op, value in (("$gte", start), ("$lte", end)) if value is not None}
+        if date_range:
+            query["date"] = date_range
+        cursor = get_history_collection().find(query, {"_id": 0}).sort([("date", 1), ("run_id", 1)])
+        return pd.DataFrame(list(cursor), columns=list(HISTORY_FIELDS))
+
+    clauses = [f"{field} = ?" for field in filters]
+    params = list(filters.values())
+    if start is not None:
+        clauses.append("date >= ?")
+        params.append(start)
+    if end is not None:
+        clauses.append("date <= ?")
+        params.append(end)
+    sql = f"SELECT {', '.join(HISTORY_FIELDS)} FROM {HISTORY_TABLE}"
+    if clauses:
+        sql += " WHERE " + " AND ".join(clauses)
+    return pd.read_sql_query(sql + " ORDER BY date, run_id", get_history_db(), params=params)
+
+
+def ticker_history(ticker, model="lstm", days=90):
+    """返回單一股票最近 days 天的預測走勢，例如 ticker_history("AAPL", "lstm", 90)"""
+    start = (datetime.date.today() - datetime.timedelta(days=days)).isoformat()
+    return load_prediction_history(ticker=ticker, model=model, start=start)
+
+
+class PredictionHistory:
+    """
+    累積一次執行的預測結果，每滿 batch_size 行就經由通知佇列批次寫入，不阻塞運算
+    :param members: {index_name: 成分股}，一檔股票的預測會寫入它所屬的每個指數
+    """
+
+    def __init__(self, run_id, date, members, batch_size=500):
+        self.run_id = run_id
+        self.date = date
+        self.batch_size = batch_size
+        self.ticker_indices = {}
+        for index_name, stock_list in members.items():
+            for ticker in stock_list:
+                self.ticker_indices.setdefault(ticker, []).append(index_name)
+        self.rows = []
+
+    def add(self, index_name, model, prediction):
+        ticker, potential, current_price, predicted_price = prediction
+        self.rows.append({
+            "run_id": self.run_id,
+            "date": self.date,
+            "index_name": index_name,
+            "ticker": ticker,
+            "model": model,
+            "potential": float(potential),
+            "current_price": float(current_price),
+            "predicted_price": float(predicted_price),
+        })
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def add_ticker(self, ticker, predictions):
+        """記錄單一股票的預測 {model: prediction}"""
+        for index_name in self.ticker_indices.get(ticker, ()):
+            for model, prediction in predictions.items():
+                self.add(index_name, model, prediction)
+
+    def flush(self):
+        if self.rows:
+            _dispatch("history", write_prediction_history, self.rows)
+            self.rows = []
 
 # Stock index mappings
 def get_tw0050_stocks():
@@ -149,11 +540,202 @@ def get_dji_stocks():
         "MCD", "HON", "AXP", "WBA", "NKE", "DOW", "BA", "HD", "CRM", "AMGN"
     ]
 
+# 價格快取與批量下載
+PRICE_COLUMNS = ['Open', 'High', 'Low', 'Close', 'Volume']
+
+
+def period_start(period, today=None):
+    """
+    將 yfinance 的 period 字串 (例如 5d、3mo、2y、ytd、max) 轉換為起始日期
+    :param period: yfinance period 字串
+    :param today: 基準日期，默認為今天
+    :return: 起始日期 (pd.Timestamp)，max 時返回 None
+    """
+    today = pd.Timestamp.today().normalize() if today is None else pd.Timestamp(today).normalize()
+    if period == "max":
+        return None
+    if period == "ytd":
+        return pd.Timestamp(year=today.year, month=1, day=1)
+    match = re.fullmatch(r"(\d+)(d|wk|mo|y)", period)
+    if not match:
+        raise ValueError(f"無法解析的 period: {period}")
+    amount, unit = int(match.group(1)), match.group(2)
+    offsets = {
+        "d": pd.DateOffset(days=amount),
+        "wk": pd.DateOffset(weeks=amount),
+        "mo": pd.DateOffset(months=amount),
+        "y": pd.DateOffset(years=amount),
+    }
+    return today - offsets[unit]
+
+
+def longest_period(periods):
+    """從多個 period 中找出涵蓋範圍最長的一個"""
+    if "max" in periods:
+        return "max"
+    return min(periods, key=period_start)
+
+
+def slice_period(data, period):
+    """從完整的價格序列中切出 period 對應的區間"""
+    start = period_start(period)
+    if data.empty or start is None:
+        return data
+    return data.loc[data.index >= start]
+
+
+# 同一進程中的多個執行緒（例如 service.py 的請求）可能同時更新快取，寫入 parquet 與 _meta.json 時需持有此鎖
+_price_cache_lock = threading.Lock()
+
+
+def _cache_path(ticker):
+    return os.path.join(price_cache_dir, f"{ticker}.parquet")
+
+
+def _load_cache_meta():
+    try:
+        with open(os.path.join(price_cache_dir, "_meta.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_cache_meta(meta):
+    # 先寫入暫存檔再替換，中斷時不會留下不完整的檔案而導致下次重新下載全部股票
+    path = os.path.join(price_cache_dir, "_meta.json")
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+def load_cached_prices(ticker):
+    """讀取本地快取的價格序列，不存在時返回 None"""
+    path = _cache_path(ticker)
+    if not price_cache_dir or not os.path.exists(path):
+        return None
+    try:
+        return pd.read_parquet(path)
+    except Exception as e:
+        print(f"讀取 {ticker} 快取失敗: {str(e)}")
+        return None
+
+
+def _split_download(raw, tickers):
+    """將 yf.download 的多股票結果拆分成 {ticker: DataFrame}"""
+    frames = {}
+    if raw is None or raw.empty:
+        return frames
+
+    if isinstance(raw.columns, pd.MultiIndex):
+        # group_by="ticker" 時股票代碼在第 0 層，否則在第 1 層
+        level = 0 if set(tickers) & set(raw.columns.get_level_values(0)) else 1
+        available = set(raw.columns.get_level_values(level))
+        for ticker in tickers:
+            if ticker in available:
+                frames[ticker] = raw.xs(ticker, axis=1, level=level)
+    elif len(tickers) == 1:
+        frames[tickers[0]] = raw
+
+    for ticker, frame in list(frames.items()):
+        frame = frame[[c for c in PRICE_COLUMNS if c in frame.columns]].dropna(subset=['Close'])
+        if frame.empty:
+            del frames[ticker]
+            continue
+        frame.index = pd.DatetimeIndex(frame.index).tz_localize(None)
+        frame.index.name = 'Date'
+        frames[ticker] = frame
+    return frames
+
+
+def _bulk_download(tickers, **kwargs):
+    """以單次請求批量下載多檔股票"""
+    try:
+        print(f"正在批量獲取 {len(tickers)} 檔股票的數據...")
+        with metrics.span("download", tickers=len(tickers)) as span:
+            raw = lazy_import("yfinance").download(tickers, group_by="ticker", progress=False, threads=True, **kwargs)
+            # yfinance 不提供實際傳輸量，以下載結果的記憶體大小近似
+            span["bytes"] = int(raw.memory_usage(deep=True).sum()) if raw is not None else 0
+        metrics.incr("download_bytes", span["bytes"])
+        frames = _split_download(raw, tickers)
+        metrics.incr("download_tickers_missing", len(tickers) - len(frames))
+        print(f"成功獲取 {len(frames)}/{len(tickers)} 檔股票的數據")
+        return frames
+    except Exception as e:
+        print(f"批量獲取數據時發生錯誤: {str(e)}")
+        return {}
+
+
+def get_index_stock_data(tickers, period, max_age=None):
+    """
+    批量獲取多檔股票的數據，並維護本地快取
+    已快取的股票只下載缺少的最新交易日，快取涵蓋範圍不足時才重新下載完整區間
+    :param tickers: 股票代碼列表
+    :param period: yfinance period 字串
+    :param max_age: 上次下載超過此秒數的股票重新下載最新交易日，默認為 PRICE_CACHE_MAX_AGE_SECONDS
+    :return: {ticker: DataFrame}，只包含 period 範圍內的數據
+    """
+    tickers = list(dict.fromkeys(tickers))
+    now = pd.Timestamp.now()
+    today = now.normalize()
+    max_age = price_cache_max_age if max_age is None else max_age
+    start = period_start(period, today)
+    meta = _load_cache_meta() if price_cache_dir else {}
+
+    cached, full_tickers, tail_tickers = {}, [], []
+    for ticker in tickers:
+        data = load_cached_prices(ticker)
+        info = meta.get(ticker)
+        covered_start = None if info is None or info["start"] is None else pd.Timestamp(info["start"])
+        if data is None or data.empty or info is None or (
+                covered_start is not None and (start is None or covered_start > start)):
+            full_tickers.append(ticker)
+            continue
+        cached[ticker] = data
+        # checked 為上次下載的時間，舊版只記錄日期，視為當天 00:00
+        if (now - pd.Timestamp(info["checked"])).total_seconds() >= max_age:
+            tail_tickers.append(ticker)
+
+    downloaded = {}
+    if full_tickers:
+        downloaded.update(_bulk_download(full_tickers, period=period))
+    if tail_tickers:
+        # 從最後一個已快取的交易日開始重新下載，覆蓋可能未收盤的數據
+        tail_start = min(cached[t].index[-1] for t in tail_tickers)
+        for ticker, frame in _bulk_download(tail_tickers, start=tail_start.strftime('%Y-%m-%d')).items():
+            merged = pd.concat([cached[ticker], frame])
+            downloaded[ticker] = merged[~merged.index.duplicated(keep='last')].sort_index()
+
+    if price_cache_dir and downloaded:
+        os.makedirs(price_cache_dir, exist_ok=True)
+        with _price_cache_lock:
+            # 重新讀取 meta 再合併這次的更新，不以開始時讀到的舊版本覆蓋其他執行緒寫入的記錄
+            meta = _load_cache_meta()
+            for ticker, frame in downloaded.items():
+                try:
+                    frame.to_parquet(_cache_path(ticker))
+                except Exception as e:
+                    print(f"寫入 {ticker} 快取失敗: {str(e)}")
+                    continue
+                previous = meta.get(ticker, {}).get("start") if ticker not in full_tickers else None
+                covered = None if start is None else start.strftime('%Y-%m-%d')
+                if previous is not None and covered is not None:
+                    covered = min(previous, covered)
+                meta[ticker] = {"start": covered, "checked": now.isoformat(timespec="seconds")}
+            _save_cache_meta(meta)
+
+    results = {}
+    for ticker in tickers:
+        data = downloaded.get(ticker, cached.get(ticker))
+        if data is not None:
+            results[ticker] = slice_period(data, period)
+    return results
+
+
 # 獲取股票數據
 def get_stock_data(ticker, period):
     try:
         print(f"正在獲取 {ticker} 的數據...")
-        data = yf.download(ticker, period=period)
+        data = get_index_stock_data([ticker], period).get(ticker, pd.DataFrame())
         print(f"獲取到 {len(data)} 條交易日數據")
         return data
     except Exception as e:
@@ -172,14 +754,74 @@ def get_stock_data(ticker, period):
 #     X = np.reshape(X, (X.shape[0], X.shape[1], 1))
 #     return X, y, scaler
 
-def prepare_data(data, time_step=60):
-    scaler = MinMaxScaler(feature_range=(0, 1))
-    scaled_data = scaler.fit_transform(data[['Open', 'High', 'Low', 'Close',   'Volume']])
-    X, y = [], []
-    for i in range(time_step, len(scaled_data)):
-        X.append(scaled_data[i - time_step:i])  # 確保 X 是 (time_step, features)
-        y.append(scaled_data[i, 3])  # 預測 Close 價        
-    X, y = np.array(X), np.array(y).reshape(-1, 1)  # y 的形狀應為 (samples, 1)
+# 滑動視窗
+# 特徵工程：OHLCV 加上可選的衍生特徵，每個特徵只依賴當天與前一天的數據，新增交易日時只需計算新的行
+DERIVED_FEATURES = {
+    "return": lambda data: data['Close'].pct_change().fillna(0.0),          # 日報酬
+    "log_volume": lambda data: np.log1p(data['Volume'].clip(lower=0)),     # 成交量取對數，壓縮極端值
+    "range": lambda data: (data['High'] - data['Low']) / data['Close'],     # 當日振幅
+}
+unknown_features = set(extra_features) - set(DERIVED_FEATURES)
+if unknown_features:
+    config_errors.append(f"未知的 EXTRA_FEATURES: {', '.join(sorted(unknown_features))}")
+    extra_features = [name for name in extra_features if name in DERIVED_FEATURES]
+FEATURE_COLUMNS = PRICE_COLUMNS + extra_features
+CLOSE_INDEX = FEATURE_COLUMNS.index('Close')
+FEATURE_WARMUP_ROWS = 1 if extra_features else 0  # return 需要前一天的收盤價
+
+
+def feature_frame(data):
+    """
+    返回模型使用的特徵 (FEATURE_COLUMNS)
+    有衍生特徵時第一行的 return 沒有前一天可比較，呼叫端需多傳入 FEATURE_WARMUP_ROWS 行再捨棄
+    """
+    if not extra_features:
+        return data[FEATURE_COLUMNS]
+    features = data[PRICE_COLUMNS].copy()
+    for name in extra_features:
+        features[name] = DERIVED_FEATURES[name](data)
+    return features
+
+
+def update_scaler(scaler, data, new_rows):
+    """
+    以最後 new_rows 個新增交易日更新 scaler 的 min / max（MinMaxScaler.partial_fit），不必重新掃描完整歷史
+    新數據都在原範圍內時 scaler 不變
+    """
+    if new_rows > 0:
+        scaler.partial_fit(feature_frame(data.iloc[-(new_rows + FEATURE_WARMUP_ROWS):]).iloc[FEATURE_WARMUP_ROWS:])
+    return scaler
+
+
+def make_windows(scaled_data, time_step=60):
+    """
+    以 strided view 建立滑動視窗，不複製數據
+    :param scaled_data: (rows, features) 的標準化數據
+    :param time_step: 視窗長度
+    :return: (rows - time_step + 1, time_step, features) 的唯讀 view，第 i 個視窗為 scaled_data[i:i + time_step]
+    """
+    return np.lib.stride_tricks.sliding_window_view(scaled_data, time_step, axis=0).transpose(0, 2, 1)
+
+
+def inference_windows(scaled_data, time_step=60, last_only=False):
+    """
+    預測用的視窗，與訓練時相同：以 scaled_data[i - time_step:i] 預測第 i 天
+    :param last_only: 只返回最後一個視窗 (1, time_step, features)
+    """
+    if last_only:
+        return scaled_data[np.newaxis, -time_step - 1:-1]
+    return make_windows(scaled_data, time_step)[:-1]
+
+
+def prepare_data(data, time_step=60, scaler=None):
+    # 傳入已擬合的 scaler 時沿用其參數（例如從模型檢查點載入），否則重新擬合
+    if scaler is None:
+        scaler = lazy_import("sklearn.preprocessing").MinMaxScaler(feature_range=(0, 1))
+        scaled_data = scaler.fit_transform(feature_frame(data))
+    else:
+        scaled_data = scaler.transform(feature_frame(data))
+    X = make_windows(scaled_data, time_step)[:-1]  # 確保 X 是 (samples, time_step, features)
+    y = scaled_data[time_step:, CLOSE_INDEX:CLOSE_INDEX + 1]  # 預測 Close 價，y 的形狀應為 (samples, 1)
     return X, y, scaler
 
 # 訓練 LSTM 模型
@@ -195,18 +837,161 @@ def prepare_data(data, time_step=60):
 #     model.compile(optimizer='adam', loss='mean_squared_error')
 #     model.fit(X_train, y_train, epochs=10, batch_size=32)
 #     return model
-def train_lstm_model(X_train, y_train):
+# 訓練預算：整次執行的截止時間（time.time()），由 main 設置並在建立進程池時傳給子進程
+run_deadline_at = None
+DEADLINE_RESERVE_FRACTION = 0.3  # 剩餘時間少於截止秒數的此比例時略過 Transformer
+
+
+def start_run_deadline():
+    global run_deadline_at
+    if run_deadline_seconds > 0:
+        run_deadline_at = time.time() + run_deadline_seconds
+
+
+def run_seconds_remaining():
+    """距離執行截止時間的秒數，沒有設置 RUN_DEADLINE_SECONDS 時返回 None"""
+    return None if run_deadline_at is None else run_deadline_at - time.time()
+
+
+def deadline_near():
+    remaining = run_seconds_remaining()
+    return remaining is not None and remaining < run_deadline_seconds * DEADLINE_RESERVE_FRACTION
+
+
+def fit_budget_seconds():
+    """單次訓練可用的秒數：FIT_TIME_BUDGET_SECONDS 與執行剩餘時間的較小者，沒有限制時返回 None"""
+    budgets = [fit_time_budget_seconds] if fit_time_budget_seconds > 0 else []
+    remaining = run_seconds_remaining()
+    if remaining is not None:
+        budgets.append(max(remaining, 0.0))
+    return min(budgets) if budgets else None
+
+
+def adaptive_batch_size(samples, min_size=8, max_size=256):
+    """依樣本數選擇 2 的次方 batch size，每個 epoch 約 32 個 step"""
+    size = 2 ** int(np.log2(max(samples // 32, 1)))
+    return int(min(max(size, min_size), max_size))
+
+
+def make_time_budget(seconds):
+    """返回在訓練時間超過 seconds 後於該 epoch 結束時停止的 Keras callback，至少完成一個 epoch"""
+    keras = lazy_import("keras")
+
+    class TimeBudget(keras.callbacks.Callback):
+        def __init__(self):
+            super().__init__()
+            self.exhausted = False
+
+        def on_train_begin(self, logs=None):
+            self.start = time.perf_counter()
+
+        def on_epoch_end(self, epoch, logs=None):
+            if time.perf_counter() - self.start >= seconds:
+                self.exhausted = True
+                self.model.stop_training = True
+
+    return TimeBudget()
+
+
+def split_validation(groups, fraction):
+    """
+    依分組切出驗證集：每組取最後 fraction 比例的樣本，即該組最近的交易日
+    :param groups: 每個樣本所屬的分組（例如 pooled 模式的 ticker_ids），同組樣本依時間排列
+    :return: (train_index, validation_index)
+    """
+    groups = np.asarray(groups)
+    train_index, validation_index = [], []
+    for group in np.unique(groups):
+        positions = np.flatnonzero(groups == group)
+        holdout = int(len(positions) * fraction)
+        train_index.append(positions[:len(positions) - holdout])
+        validation_index.append(positions[len(positions) - holdout:])
+    return np.concatenate(train_index), np.concatenate(validation_index)
+
+
+def _take(X, index):
+    """從單一輸入或多輸入（list）的訓練數據中取出指定樣本"""
+    return [part[index] for part in X] if isinstance(X, list) else X[index]
+
+
+def fit_model(model, X_train, y_train, stats, epochs=10, batch_size=32, groups=None):
+    """
+    訓練模型並將收斂資訊寫入 stats（fit span 的標籤）
+    ADAPTIVE_TRAINING 時以驗證集提前停止並調整 batch size；設置時間預算時超時即停止
+    :param stats: 補上 epochs、batch_size、stopped（max_epochs / early_stopping / budget），自適應時另有 best_epoch、best_loss
+    :param groups: 多檔股票堆疊訓練時每個樣本所屬的股票，驗證集改由每檔股票各自最近的樣本組成
+    """
+    callbacks = []
+    budget = fit_budget_seconds()
+    time_budget = make_time_budget(budget) if budget is not None else None
+    if time_budget is not None:
+        callbacks.append(time_budget)
+
+    samples = len(y_train)
+    monitor = None
+    fit_kwargs = {"epochs": epochs, "batch_size": batch_size}
+    if adaptive_training:
+        # validation_split 取最後的樣本，即最近的交易日，符合時間序列的驗證方式
+        use_validation = 1 <= int(samples * validation_split) < samples
+        fit_kwargs = {
+            "epochs": max_epochs,
+            "batch_size": adaptive_batch_size(samples),
+            "validation_split": validation_split if use_validation else 0.0,
+        }
+        if groups is not None:
+            # 堆疊的樣本按股票排列，最後的樣本是最後幾檔股票而非最近的交易日，改為每檔股票各自切出驗證集
+            train_index, validation_index = split_validation(groups, validation_split)
+            use_validation = len(validation_index) >= 1 and len(train_index) >= 1
+            if use_validation:
+                fit_kwargs["validation_split"] = 0.0
+                fit_kwargs["validation_data"] = (_take(X_train, validation_index), y_train[validation_index])
+                X_train, y_train = _take(X_train, train_index), y_train[train_index]
+        monitor = "val_loss" if use_validation else "loss"
+        early_stopping = lazy_import("keras").callbacks.EarlyStopping(monitor=monitor, patience=early_stopping_patience, restore_best_weights=True)
+        callbacks.append(early_stopping)
+
+    history = model.fit(X_train, y_train, callbacks=callbacks, verbose=keras_verbose, **fit_kwargs)
+    epochs_run = len(history.history["loss"])
+    if time_budget is not None and time_budget.exhausted:
+        stopped = "budget"
+    elif epochs_run < fit_kwargs["epochs"]:
+        stopped = "early_stopping"
+    else:
+        stopped = "max_epochs"
+    stats.update(epochs=epochs_run, batch_size=fit_kwargs["batch_size"], stopped=stopped)
+
+    if monitor is not None:
+        losses = history.history[monitor]
+        best = int(np.argmin(losses))
+        stats.update(best_epoch=best + 1, best_loss=round(float(losses[best]), 6), monitor=monitor)
+        # 因時間預算停止時 EarlyStopping 不會還原權重，手動還原到最佳 epoch
+        if stopped == "budget" and early_stopping.best_weights is not None:
+            model.set_weights(early_stopping.best_weights)
+    metrics.incr("fit_stopped", model=stats.get("model"), reason=stopped)
+    return model
+
+
+def build_lstm_model(input_shape):
+    keras = lazy_import("keras")
+    layers = keras.layers
     # 使用多個特徵作為輸入
-    model = Sequential([
-        Input(shape=(X_train.shape[1], X_train.shape[2])),  # 修改輸入形狀
-        LSTM(units=50, return_sequences=True),
-        Dropout(0.2),
-        LSTM(units=50, return_sequences=False),
-        Dropout(0.2),
-        Dense(units=1)  # 預測 Close
+    model = keras.Sequential([
+        keras.Input(shape=input_shape),  # 修改輸入形狀
+        layers.LSTM(units=50, return_sequences=True),
+        layers.Dropout(0.2),
+        layers.LSTM(units=50, return_sequences=False),
+        layers.Dropout(0.2),
+        layers.Dense(units=1)  # 預測 Close
     ])
     model.compile(optimizer='adam', loss='mean_squared_error')
-    model.fit(X_train, y_train, epochs=10, batch_size=32)
+    return model
+
+
+def train_lstm_model(X_train, y_train):
+    with metrics.span("build", model="lstm"):
+        model = build_lstm_model((X_train.shape[1], X_train.shape[2]))
+    with metrics.span("fit", model="lstm", samples=len(X_train)) as stats:
+        fit_model(model, X_train, y_train, stats)
     return model
 
 
@@ -219,31 +1004,86 @@ def train_lstm_model(X_train, y_train):
 #     predicted_prices = model.predict(X_test)
 #     return scaler.inverse_transform(predicted_prices)
 
-def predict_stock(model, data, scaler, time_step=60):
+def predict_stock(model, data, scaler, time_step=60, last_only=False):
+    # last_only 時只需標準化最後 time_step + 1 天（加上衍生特徵需要的前一天），並只對最後一個視窗做一次前向計算
+    if last_only:
+        data = data.iloc[-time_step - 1 - FEATURE_WARMUP_ROWS:]
+
     # 使用多個特徵進行標準化
-    scaled_data = scaler.transform(data[['Open', 'High', 'Low', 'Close',   'Volume']])
+    scaled_data = scaler.transform(feature_frame(data))
 
     # 準備測試集
-    X_test = [scaled_data[i-time_step:i] for i in range(time_step, len(scaled_data))]
-    X_test = np.array(X_test)
+    X_test = inference_windows(scaled_data, time_step, last_only)
 
     # LSTM 預測
-    predicted_prices = model.predict(X_test)
+    with metrics.span("predict", model="lstm", samples=len(X_test)):
+        predicted_prices = model.predict(X_test, verbose=keras_verbose)
 
     # 反標準化，僅對 `Close` 特徵進行反標準化
-    close_index = 3  # 'Close' 的索引
-    predicted_close_prices = scaler.inverse_transform(
-        np.concatenate([
-            np.zeros((predicted_prices.shape[0], close_index)),  # 填充多餘的維度
-            predicted_prices,  # 插入預測的 Close
-            np.zeros((predicted_prices.shape[0], scaled_data.shape[1] - close_index - 1))  # 填充多餘的維度
-        ], axis=1)
-    )[:, close_index]  # 只取反標準化後的 Close
-    return predicted_close_prices
+    return inverse_transform_close(scaler, predicted_prices[:, 0])
+
+
+def inverse_transform_close(scaler, predicted_prices, close_index=CLOSE_INDEX):
+    """
+    只對 Close 特徵進行反標準化
+    :param scaler: prepare_data 返回的 scaler
+    :param predicted_prices: (samples,) 的標準化 Close 預測值
+    :param close_index: Close 特徵在 scaled_data 中的索引
+    """
+    # MinMaxScaler 的轉換為 X * scale_ + min_，直接對 Close 這一欄反推，不需要構建完整寬度的數組
+    return (np.asarray(predicted_prices, dtype=np.float64) - scaler.min_[close_index]) / scaler.scale_[close_index]
 
 
 # Prophet 預測股票
-def train_prophet_model(data):
+def _prophet_cache_path(ticker):
+    return os.path.join(model_dir, "prophet", f"{ticker}.json")
+
+
+def _prophet_fingerprint(df):
+    """Prophet 依賴全部歷史數據，以 (ds, y) 的完整內容作為指紋"""
+    digest = hashlib.sha1(df['ds'].values.astype('datetime64[ns]').tobytes())
+    digest.update(np.round(df['y'].values.astype(np.float64), 6).tobytes())
+    return digest.hexdigest()
+
+
+def load_cached_prophet_model(ticker):
+    """
+    載入之前擬合的 Prophet 模型
+    :return: (model, fingerprint)，不存在或載入失敗時返回 None
+    """
+    path = _prophet_cache_path(ticker)
+    if not model_dir or not os.path.exists(path):
+        return None
+    try:
+        with open(path, encoding="utf-8") as f:
+            cached = json.load(f)
+        return lazy_import("prophet.serialize").model_from_json(cached["model"]), cached["fingerprint"]
+    except Exception as e:
+        print(f"載入 Prophet 模型快取失敗: {ticker}, 錯誤: {str(e)}")
+        return None
+
+
+def _prophet_init(model):
+    """以已擬合模型的參數作為下一次擬合的初始值，數據只多了幾個交易日時優化器很快收斂"""
+    params = model.params
+    init = {name: float(params[name][0][0]) for name in ("k", "m", "sigma_obs")}
+    init.update({name: params[name][0] for name in ("delta", "beta")})
+    return init
+
+
+def save_prophet_model(ticker, model, fingerprint):
+    if not model_dir:
+        return
+    path = _prophet_cache_path(ticker)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"fingerprint": fingerprint, "model": lazy_import("prophet.serialize").model_to_json(model)}, f)
+    except Exception as e:
+        print(f"保存 Prophet 模型快取失敗: {ticker}, 錯誤: {str(e)}")
+
+
+def train_prophet_model(data, ticker=None):
     # 重置索引并准备数据
     df = data.reset_index()[['Date', 'Close']]
     df.columns = ['ds', 'y']  # Prophet 要求的格式
@@ -257,9 +1097,29 @@ def train_prophet_model(data):
     if len(df) < 30:  # 至少需要 30 条数据
         raise ValueError("数据不足，无法训练 Prophet 模型")
 
+    # 提供 ticker 且數據與上次相同時，直接沿用已擬合的模型；數據視窗前移時以上次的參數作為初始值重新擬合
+    fingerprint = _prophet_fingerprint(df) if ticker else None
+    cached = load_cached_prophet_model(ticker) if ticker else None
+    if cached is not None and cached[1] == fingerprint:
+        metrics.incr("prophet_cache_hits")
+        return cached[0]
+
     # 初始化 Prophet 模型 
-    model = Prophet(yearly_seasonality=True, daily_seasonality=True, changepoint_prior_scale=0.1)
-    model.fit(df)
+    prophet = lazy_import("prophet")
+    model = prophet.Prophet(yearly_seasonality=True, daily_seasonality=True, changepoint_prior_scale=0.1)
+    with metrics.span("fit", model="prophet", samples=len(df), warm_start=cached is not None) as stats:
+        try:
+            model.fit(df, init=_prophet_init(cached[0])) if cached is not None else model.fit(df)
+        except Exception as e:
+            if cached is None:
+                raise
+            # 參數形狀不同（例如數據太短時 changepoint 數量減少）時改為從頭擬合；Prophet 物件只能擬合一次，需重新建立
+            print(f"Prophet 沿用參數擬合失敗，改為從頭擬合: {ticker}, 錯誤: {str(e)}")
+            stats["warm_start"] = False
+            model = prophet.Prophet(yearly_seasonality=True, daily_seasonality=True, changepoint_prior_scale=0.1)
+            model.fit(df)
+    if ticker:
+        save_prophet_model(ticker, model, fingerprint)
     return model
 
 # Prophet 预测股票
@@ -274,60 +1134,71 @@ def predict_with_prophet(model, data, prediction_days=3):
     # 获取最新的 Close 值
     last_close = data['Close'].values[-1]
 
-    # 创建未来日期
-    future = model.make_future_dataframe(periods=prediction_days)
+    # 只创建未来日期，不再对全部历史数据做预测
+    future = model.make_future_dataframe(periods=prediction_days, include_history=False)
 
     # 预测未来数据
-    forecast = model.predict(future)
+    with metrics.span("predict", model="prophet"):
+        forecast = model.predict(future)
 
     # 設置合理的上下限，避免預測值過於誇張
     lower_bound = last_close * 0.8
     upper_bound = last_close * 1.2
-    forecast['yhat'] = forecast['yhat'].apply(lambda x: min(max(x, lower_bound), upper_bound))
+    forecast['yhat'] = forecast['yhat'].clip(lower_bound, upper_bound)
 
     # 返回最近的預測值
-    return forecast.tail(prediction_days)[['ds', 'yhat', 'yhat_lower', 'yhat_upper']]
+    return forecast[['ds', 'yhat', 'yhat_lower', 'yhat_upper']]
 
 
 # 構建 Transformer 模型
-def build_transformer_model(input_shape):
-    inputs = Input(shape=input_shape)
-    
+def _transformer_encoder(inputs):
+    layers = lazy_import("keras").layers
     # Transformer Encoder Layer
-    attention = MultiHeadAttention(num_heads=4, key_dim=input_shape[-1])(inputs, inputs)
-    attention = Dropout(0.1)(attention)
-    attention = Add()([inputs, attention])  # 殘差連接
-    attention = LayerNormalization(epsilon=1e-6)(attention)
+    attention = layers.MultiHeadAttention(num_heads=4, key_dim=inputs.shape[-1])(inputs, inputs)
+    attention = layers.Dropout(0.1)(attention)
+    attention = layers.Add()([inputs, attention])  # 殘差連接
+    attention = layers.LayerNormalization(epsilon=1e-6)(attention)
 
     # Feed Forward Layer
-    feed_forward = Dense(64, activation="relu")(attention)
-    feed_forward = Dropout(0.1)(feed_forward)
-    outputs = Dense(1)(feed_forward)  # 預測 Close 價
-    
-    model = Model(inputs, outputs)
-    model.compile(optimizer=Adam(learning_rate=0.001), loss="mean_squared_error")
+    feed_forward = layers.Dense(64, activation="relu")(attention)
+    feed_forward = layers.Dropout(0.1)(feed_forward)
+    return layers.Dense(1)(feed_forward)  # 預測 Close 價
+
+
+def build_transformer_model(input_shape):
+    keras = lazy_import("keras")
+    inputs = keras.Input(shape=input_shape)
+    outputs = _transformer_encoder(inputs)
+    model = keras.Model(inputs, outputs)
+    model.compile(optimizer=keras.optimizers.Adam(learning_rate=0.001), loss="mean_squared_error")
     return model
 
 # 訓練 Transformer 模型
 def train_transformer_model(X_train, y_train, input_shape):
-    model = build_transformer_model(input_shape)
-    model.fit(X_train, y_train, epochs=10, batch_size=32)
+    with metrics.span("build", model="transformer"):
+        model = build_transformer_model(input_shape)
+    with metrics.span("fit", model="transformer", samples=len(X_train)) as stats:
+        fit_model(model, X_train, y_train, stats)
     return model
 
 # Transformer 預測
-def predict_transformer(model, data, scaler, time_step=60):
+def predict_transformer(model, data, scaler, time_step=60, last_only=False):
+    # last_only 時只需標準化最後 time_step + 1 天（加上衍生特徵需要的前一天），並只對最後一個視窗做一次前向計算
+    if last_only:
+        data = data.iloc[-time_step - 1 - FEATURE_WARMUP_ROWS:]
+
     # 使用多個特徵進行標準化
-    scaled_data = scaler.transform(data[['Open', 'High', 'Low', 'Close',   'Volume']])
+    scaled_data = scaler.transform(feature_frame(data))
 
     # 準備測試集
-    X_test = [scaled_data[i-time_step:i] for i in range(time_step, len(scaled_data))]
-    X_test = np.array(X_test)
+    X_test = inference_windows(scaled_data, time_step, last_only)
 
     # 打印 X_test 的形狀
     print(f"X_test shape: {X_test.shape}")
 
     # Transformer 預測
-    predicted_prices = model.predict(X_test)
+    with metrics.span("predict", model="transformer", samples=len(X_test)):
+        predicted_prices = model.predict(X_test, verbose=keras_verbose)
 
     # 修正 predicted_prices 的形狀
     if len(predicted_prices.shape) > 2:
@@ -337,15 +1208,568 @@ def predict_transformer(model, data, scaler, time_step=60):
     print(f"predicted_prices shape after reshape: {predicted_prices.shape}")
 
     # 反標準化，只對 Close 特徵進行
-    close_index = 3  # Close 特徵在 scaled_data 中的索引
+    return inverse_transform_close(scaler, predicted_prices)
+
+
+# 模型檢查點：保存權重、scaler 參數與數據指紋，下次執行時只用新增的交易日微調
+MODEL_VERSIONS = {"lstm": 1, "transformer": 1, "pooled_lstm": 1, "pooled_transformer": 1}  # 修改模型結構時遞增
+
+
+def _architecture_id(model_type, time_step=60):
+    return f"{model_type}-v{MODEL_VERSIONS[model_type]}-{','.join(FEATURE_COLUMNS)}-{time_step}"
+
+
+def _checkpoint_paths(model_type, key):
+    base = os.path.join(model_dir, model_type, key)
+    return f"{base}.keras", f"{base}.json"
+
+
+def _data_fingerprint(data, time_step=60):
+    """以最後交易日和最後 time_step 天的 Close 作為數據指紋，用於偵測除權息等歷史數據修正"""
+    tail = np.round(data['Close'].values[-time_step:].astype(np.float64), 4)
+    return {
+        "last_date": data.index[-1].strftime('%Y-%m-%d'),
+        "tail_hash": hashlib.sha1(tail.tobytes()).hexdigest(),
+    }
+
+
+def _count_new_rows(data, fingerprint, time_step=60):
+    """返回檢查點之後新增的交易日數，歷史數據與檢查點不一致時返回 None"""
+    last_date = pd.Timestamp(fingerprint["last_date"])
+    old_data = data.loc[data.index <= last_date]
+    if len(old_data) < time_step or old_data.index[-1] != last_date:
+        return None
+    if _data_fingerprint(old_data, time_step)["tail_hash"] != fingerprint["tail_hash"]:
+        return None
+    return len(data) - len(old_data)
+
+
+def _scaler_params(scaler):
+    return {"data_min": scaler.data_min_.tolist(), "data_max": scaler.data_max_.tolist()}
+
 
-    # 構建完整的數據結構，填充到與 scaled_data 一致的形狀
-    full_predictions = np.zeros((predicted_prices.shape[0], scaled_data.shape[1]))
-    full_predictions[:, close_index] = predicted_prices  # 插入 Close 預測值
+def _restore_scaler(params):
+    # 以 [min, max] 兩行數據重新擬合，得到與原 scaler 完全相同的參數
+    scaler = lazy_import("sklearn.preprocessing").MinMaxScaler(feature_range=(0, 1))
+    scaler.fit(pd.DataFrame([params["data_min"], params["data_max"]], columns=FEATURE_COLUMNS))
+    return scaler
+
+
+def save_model_checkpoint(model_type, key, model, scalers, ticker_frames, trained_at, time_step=60):
+    """
+    保存模型權重、每檔股票的 scaler 參數與數據指紋
+    :param scalers: {ticker: scaler}
+    :param ticker_frames: {ticker: 訓練時使用的 DataFrame}
+    :param trained_at: 最近一次完整訓練的時間，用於判斷是否過期
+    """
+    if not model_dir:
+        return
+    model_path, meta_path = _checkpoint_paths(model_type, key)
+    try:
+        os.makedirs(os.path.dirname(model_path), exist_ok=True)
+        model.save(model_path)
+        meta = {
+            "architecture": _architecture_id(model_type, time_step),
+            "trained_at": trained_at.isoformat(),
+            "updated_at": datetime.datetime.now().isoformat(),
+            "tickers": {
+                ticker: {**_scaler_params(scaler), **_data_fingerprint(ticker_frames[ticker], time_step)}
+                for ticker, scaler in scalers.items()
+            },
+        }
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+    except Exception as e:
+        print(f"保存模型檢查點失敗: {model_type}/{key}, 錯誤: {str(e)}")
+
+
+def load_model_checkpoint(model_type, key, time_step=60):
+    """
+    載入仍可沿用的模型檢查點，結構或特徵改變、或超過 MODEL_MAX_AGE_DAYS 時返回 None
+    :return: (model, meta) 或 None
+    """
+    if not model_dir:
+        return None
+    model_path, meta_path = _checkpoint_paths(model_type, key)
+    if not (os.path.exists(model_path) and os.path.exists(meta_path)):
+        return None
+    try:
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta["architecture"] != _architecture_id(model_type, time_step):
+            return None
+        age = datetime.datetime.now() - datetime.datetime.fromisoformat(meta["trained_at"])
+        if age > datetime.timedelta(days=model_max_age_days):
+            return None
+        return lazy_import("keras").models.load_model(model_path), meta
+    except Exception as e:
+        print(f"載入模型檢查點失敗: {model_type}/{key}, 錯誤: {str(e)}")
+        return None
+
+
+def _warm_start_rows(checkpoint_meta, ticker_frames, time_step=60):
+    """
+    檢查點仍適用時，返回每檔股票新增的交易日數與沿用的 scaler
+    :return: ({ticker: new_rows}, {ticker: scaler})，任一股票的歷史數據不一致時返回 None
+    """
+    if list(checkpoint_meta["tickers"]) != list(ticker_frames):
+        return None
+    new_rows, scalers = {}, {}
+    for ticker, data in ticker_frames.items():
+        info = checkpoint_meta["tickers"][ticker]
+        new_rows[ticker] = _count_new_rows(data, info, time_step)
+        if new_rows[ticker] is None:
+            return None
+        scalers[ticker] = _restore_scaler(info)
+    return new_rows, scalers
+
+
+def train_model(model_type, X_train, y_train):
+    """從頭訓練單一股票的 LSTM 或 Transformer 模型"""
+    if model_type == "lstm":
+        return train_lstm_model(X_train, y_train)
+    return train_transformer_model(X_train, y_train, (X_train.shape[1], X_train.shape[2]))
+
+
+def finetune_windows(scaler, data, new_rows, time_step=60):
+    """
+    以最後 new_rows 個新增交易日擴展 scaler 的 min / max，並返回只包含這些交易日的訓練樣本
+    新交易日超出原本的範圍時微調會讓模型適應新的尺度；scaler 會被原地更新
+    :param data: 結尾為新增交易日的數據，至少包含 time_step + new_rows 天
+    :return: (X, y)
+    """
+    if new_rows <= 0:
+        return np.empty((0, time_step, len(FEATURE_COLUMNS))), np.empty((0, 1))
+    update_scaler(scaler, data, new_rows)
+    X, y, _ = prepare_data(data.iloc[-(time_step + new_rows + FEATURE_WARMUP_ROWS):], time_step, scaler)
+    return X[-new_rows:], y[-new_rows:]
+
+
+def finetune_model(model, scaler, data, new_rows, epochs, model_type=None, time_step=60):
+    """
+    只以新增的交易日微調已訓練的單一股票模型（檢查點、回測與盤中模式共用）
+    :param model_type: 只用於 finetune 區段的標籤
+    """
+    X, y = finetune_windows(scaler, data, new_rows, time_step)
+    with metrics.span("finetune", model=model_type, samples=len(X)):
+        model.fit(X, y, epochs=epochs, batch_size=32, verbose=keras_verbose)
+    return model
+
+
+def fit_ticker_model(model_type, ticker, data, time_step=60):
+    """
+    訓練單一股票的 LSTM / Transformer 模型，檢查點可用時只以新增交易日微調
+    :return: (model, scaler)
+    """
+    checkpoint = load_model_checkpoint(model_type, ticker, time_step)
+    if checkpoint is not None:
+        model, meta = checkpoint
+        warm_start = _warm_start_rows(meta, {ticker: data}, time_step)
+        if warm_start is not None:
+            new_rows, scalers = warm_start
+            if new_rows[ticker] > 0:
+                print(f"以 {new_rows[ticker]} 個新樣本微調 {model_type} 模型: {ticker}")
+                finetune_model(model, scalers[ticker], data, new_rows[ticker], finetune_epochs, model_type, time_step)
+                save_model_checkpoint(model_type, ticker, model, scalers, {ticker: data},
+                                      datetime.datetime.fromisoformat(meta["trained_at"]), time_step)
+            return model, scalers[ticker]
+
+    X_train, y_train, scaler = prepare_data(data, time_step)
+    model = train_model(model_type, X_train, y_train)
+    save_model_checkpoint(model_type, ticker, model, {ticker: scaler}, {ticker: data}, datetime.datetime.now(), time_step)
+    return model, scaler
+
+
+# TFLite 推論：每檔股票只預測最後一個視窗，TFLite 直譯器比 Keras predict 的固定開銷低很多
+TFLITE_QUANTIZATIONS = ("none", "float16", "int8")
+
+
+def export_lite_model(model, quantization="none"):
+    """
+    將單輸入的 Keras 模型轉換為 TFLite
+    LSTM 必須先凍結成 batch 固定為 1 的計算圖才能轉換，因此轉換後每次只能預測一個視窗
+    :param quantization: none、float16 或 int8（動態範圍量化，權重為 int8）
+    :return: TFLite 模型內容 (bytes)
+    """
+    tf = lazy_import("tensorflow")
+    convert_variables_to_constants_v2 = lazy_import(
+        "tensorflow.python.framework.convert_to_constants").convert_variables_to_constants_v2
+
+    if quantization not in TFLITE_QUANTIZATIONS:
+        raise ValueError(f"不支援的 TFLITE_QUANTIZATION: {quantization}")
+    input_shape = tuple(model.inputs[0].shape[1:])
+    concrete = tf.function(lambda x: model(x, training=False)).get_concrete_function(
+        tf.TensorSpec((1,) + input_shape, tf.float32))
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([convert_variables_to_constants_v2(concrete)])
+    if quantization != "none":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    return converter.convert()
+
+
+class LiteModel:
+    """包裝 TFLite 直譯器，提供與 Keras model.predict 相同的介面，可直接傳給 predict_stock / predict_transformer"""
+
+    def __init__(self, content):
+        tf = lazy_import("tensorflow")
+
+        self.content = content
+        self.interpreter = tf.lite.Interpreter(model_content=content)
+        self.interpreter.allocate_tensors()
+        self.input_index = self.interpreter.get_input_details()[0]["index"]
+        self.output_index = self.interpreter.get_output_details()[0]["index"]
+        self.lock = threading.Lock()  # 直譯器不是線程安全的
+
+    def predict(self, X, verbose=0):
+        outputs = []
+        with self.lock:
+            for window in np.asarray(X, dtype=np.float32):
+                self.interpreter.set_tensor(self.input_index, np.ascontiguousarray(window[np.newaxis]))
+                self.interpreter.invoke()
+                outputs.append(self.interpreter.get_tensor(self.output_index).copy())
+        return np.concatenate(outputs)
+
+
+def _checkpoint_version(model_type, key):
+    """返回模型檢查點目前的版本（最近一次保存的 updated_at），沒有檢查點時返回 None"""
+    if not model_dir:
+        return None
+    _, meta_path = _checkpoint_paths(model_type, key)
+    try:
+        with open(meta_path, encoding="utf-8") as f:
+            return re.sub(r"\D", "", json.load(f)["updated_at"])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _lite_path(model_type, key, quantization, version):
+    # 檔名帶檢查點版本，檢查點被微調或重新訓練後舊的 TFLite 模型自然失效
+    return os.path.join(model_dir, model_type, f"{key}.{quantization}.{version}.tflite")
+
+
+def load_lite_model(model_type, key, quantization=None):
+    """載入與目前檢查點版本相同的 TFLite 模型，不存在時返回 None"""
+    version = _checkpoint_version(model_type, key)
+    if version is None:
+        return None
+    lite_path = _lite_path(model_type, key, quantization or tflite_quantization, version)
+    if not os.path.exists(lite_path):
+        return None
+    try:
+        with open(lite_path, "rb") as f:
+            return LiteModel(f.read())
+    except Exception as e:
+        print(f"載入 TFLite 模型失敗: {model_type}/{key}, 錯誤: {str(e)}")
+        return None
+
+
+def _save_lite_model(model_type, key, lite_model, version):
+    """保存 TFLite 模型並刪除同一股票舊版本檢查點的 TFLite 模型"""
+    directory = os.path.join(model_dir, model_type)
+    lite_path = _lite_path(model_type, key, tflite_quantization, version)
+    prefix = f"{key}.{tflite_quantization}."
+    try:
+        with open(lite_path, "wb") as f:
+            f.write(lite_model.content)
+        for name in os.listdir(directory):
+            if name.startswith(prefix) and name.endswith(".tflite") and os.path.join(directory, name) != lite_path:
+                os.remove(os.path.join(directory, name))
+    except OSError as e:
+        print(f"保存 TFLite 模型失敗: {model_type}/{key}, 錯誤: {str(e)}")
+
+
+def to_inference_model(model_type, key, model):
+    """
+    INFERENCE_BACKEND=tflite 且已有與目前檢查點版本相同的 TFLite 模型時返回它，否則原樣返回 Keras 模型
+    批次執行每天都會微調檢查點，轉換結果無法沿用到下一次執行，因此這裡只載入、不轉換；轉換由 export_inference_model 負責
+    """
+    if inference_backend != "tflite":
+        return model
+    lite_model = load_lite_model(model_type, key)
+    return lite_model if lite_model is not None else model
+
+
+def export_inference_model(model_type, key, model, data, scaler, keras_price, time_step=60):
+    """
+    將 Keras 模型轉換為 TFLite，供之後的預測沿用（例如常駐服務的模型快取，或載入同一版本檢查點的執行）
+    以已算出的 Keras 預測價格檢驗轉換結果，差異（換算為標準化後的數值）超過 TFLITE_TOLERANCE 時沿用 Keras
+    :param keras_price: Keras 模型對最後一個視窗的預測價格
+    :return: 轉換成功時返回 LiteModel，否則返回 None
+    """
+    version = _checkpoint_version(model_type, key)
+    predict = predict_stock if model_type == "lstm" else predict_transformer
+    try:
+        with metrics.span("tflite_export", model=model_type, quantization=tflite_quantization):
+            lite_model = LiteModel(export_lite_model(model, tflite_quantization))
+        lite_price = float(predict(lite_model, data, scaler, time_step, last_only=True)[-1])
+    except Exception as e:
+        metrics.incr("tflite_fallback", model=model_type)
+        print(f"TFLite 轉換失敗，改用 Keras: {model_type}/{key}, 錯誤: {str(e)}")
+        return None
+    diff = abs(lite_price - keras_price) * scaler.scale_[CLOSE_INDEX]
+    if diff > tflite_tolerance:
+        metrics.incr("tflite_fallback", model=model_type)
+        print(f"TFLite 預測差異 {diff:.6f} 超過容許值 {tflite_tolerance}，改用 Keras: {model_type}/{key}")
+        return None
+
+    if version is not None:
+        _save_lite_model(model_type, key, lite_model, version)
+    return lite_model
+
+
+# 整個指數共用一個模型（pooled 模式）
+def pooled_frames(ticker_frames, time_step=60):
+    """
+    篩選至少有一個訓練視窗且特徵沒有缺值的股票
+    訓練、保存檢查點、檢查檢查點與預測都使用篩選後的同一組股票，成分股不變時才能沿用檢查點
+    """
+    return {
+        ticker: data for ticker, data in ticker_frames.items()
+        if len(data) > time_step and not feature_frame(data).isna().to_numpy().any()
+    }
+
+
+def prepare_pooled_data(ticker_frames, time_step=60):
+    """
+    將指數內所有股票的視窗堆疊成一份訓練集，每檔股票仍使用各自的 scaler
+    :param ticker_frames: {ticker: DataFrame}，應先經 pooled_frames 篩選
+    :return: X, y, ticker_ids, scalers；ticker_ids 為每個樣本所屬股票在 scalers 中的序號（即 Embedding 的序號）
+    """
+    X_parts, y_parts, id_parts, scalers = [], [], [], {}
+    for ticker, data in ticker_frames.items():
+        if len(data) <= time_step:
+            continue
+        try:
+            X, y, scaler = prepare_data(data, time_step)
+        except Exception as e:
+            print(f"準備 {ticker} 數據失敗: {str(e)}")
+            continue
+        id_parts.append(np.full(len(X), len(scalers), dtype=np.int32))
+        scalers[ticker] = scaler
+        X_parts.append(X)
+        y_parts.append(y)
+    if not scalers:
+        raise ValueError("沒有足夠數據的股票，無法訓練 pooled 模型")
+    return np.concatenate(X_parts), np.concatenate(y_parts), np.concatenate(id_parts), scalers
+
+
+def build_pooled_model(model_type, input_shape, n_tickers, embedding_dim=4):
+    """
+    構建整個指數共用的 LSTM / Transformer 模型
+    embedding_dim > 0 時，股票代碼經 Embedding 後拼接到每個時間步的特徵上
+    """
+    keras = lazy_import("keras")
+    layers = keras.layers
+    window_inputs = keras.Input(shape=input_shape)
+    ticker_inputs = keras.Input(shape=(1,), dtype="int32")
+    features = window_inputs
+    if embedding_dim > 0:
+        ticker_embedding = layers.Flatten()(layers.Embedding(n_tickers, embedding_dim)(ticker_inputs))
+        ticker_embedding = layers.RepeatVector(input_shape[0])(ticker_embedding)
+        features = layers.Concatenate()([window_inputs, ticker_embedding])
+
+    if model_type == "lstm":
+        x = layers.LSTM(units=50, return_sequences=True)(features)
+        x = layers.Dropout(0.2)(x)
+        x = layers.LSTM(units=50, return_sequences=False)(x)
+        x = layers.Dropout(0.2)(x)
+        outputs = layers.Dense(units=1)(x)
+        model = keras.Model([window_inputs, ticker_inputs], outputs)
+        model.compile(optimizer='adam', loss='mean_squared_error')
+    else:
+        outputs = _transformer_encoder(features)
+        model = keras.Model([window_inputs, ticker_inputs], outputs)
+        model.compile(optimizer=keras.optimizers.Adam(learning_rate=0.001), loss="mean_squared_error")
+    return model
+
+
+def train_pooled_model(model_type, X_train, y_train, ticker_ids, n_tickers, epochs=10, batch_size=128):
+    with metrics.span("build", model=f"pooled_{model_type}"):
+        model = build_pooled_model(model_type, (X_train.shape[1], X_train.shape[2]), n_tickers, pooled_embedding_dim)
+    with metrics.span("fit", model=f"pooled_{model_type}", samples=len(X_train)) as stats:
+        fit_model(model, [X_train, ticker_ids], y_train, stats, epochs, batch_size, groups=ticker_ids)
+    return model
+
+
+def predict_pooled(model, ticker_frames, scalers, time_step=60):
+    """
+    以一次批量 predict 產出指數內所有股票的下一個 Close 預測
+    :param ticker_frames: {ticker: DataFrame}
+    :param scalers: prepare_pooled_data 返回的 scalers，其順序即訓練時的 Embedding 序號
+    :return: {ticker: predicted_close_price}
+    """
+    tickers, windows, ticker_ids = [], [], []
+    for ticker_id, (ticker, scaler) in enumerate(scalers.items()):
+        if ticker not in ticker_frames:
+            continue
+        data = ticker_frames[ticker]
+        scaled_data = scaler.transform(feature_frame(data.iloc[-time_step - 1 - FEATURE_WARMUP_ROWS:]))
+        tickers.append(ticker)
+        windows.append(inference_windows(scaled_data, time_step, last_only=True))
+        ticker_ids.append(ticker_id)
+
+    with metrics.span("predict", samples=len(windows)):
+        predicted_prices = model.predict([np.concatenate(windows), np.array(ticker_ids, dtype=np.int32)], verbose=keras_verbose)
+    if len(predicted_prices.shape) > 2:
+        predicted_prices = predicted_prices[:, -1, 0]  # Transformer 取最後一個時間步的預測值
+    else:
+        predicted_prices = predicted_prices[:, 0]
+
+    return {
+        ticker: float(inverse_transform_close(scalers[ticker], predicted_prices[i:i + 1])[0])
+        for i, ticker in enumerate(tickers)
+    }
+
+
+def fit_pooled_model(model_type, index_name, ticker_frames, time_step=60):
+    """
+    訓練指數共用模型，檢查點可用且成分股不變時只以新增交易日微調
+    :return: (model, scalers)
+    """
+    checkpoint_type = f"pooled_{model_type}"
+    checkpoint = load_model_checkpoint(checkpoint_type, index_name, time_step)
+    if checkpoint is not None:
+        model, meta = checkpoint
+        warm_start = _warm_start_rows(meta, ticker_frames, time_step)
+        if warm_start is not None:
+            new_rows, scalers = warm_start
+            X_parts, y_parts = zip(*(finetune_windows(scalers[ticker], data, new_rows[ticker], time_step)
+                                     for ticker, data in ticker_frames.items()))
+            ticker_ids = np.concatenate([np.full(len(X), i, dtype=np.int32) for i, X in enumerate(X_parts)])
+            if len(ticker_ids) > 0:
+                print(f"以 {len(ticker_ids)} 個新樣本微調 {model_type} pooled 模型: {index_name}")
+                with metrics.span("finetune", model=checkpoint_type, samples=len(ticker_ids)):
+                    model.fit([np.concatenate(X_parts), ticker_ids], np.concatenate(y_parts),
+                              epochs=finetune_epochs, batch_size=128, verbose=keras_verbose)
+                save_model_checkpoint(checkpoint_type, index_name, model, scalers, ticker_frames,
+                                      datetime.datetime.fromisoformat(meta["trained_at"]), time_step)
+            return model, scalers
+
+    X_train, y_train, ticker_ids, scalers = prepare_pooled_data(ticker_frames, time_step)
+    model = train_pooled_model(model_type, X_train, y_train, ticker_ids, len(scalers))
+    save_model_checkpoint(checkpoint_type, index_name, model, scalers, ticker_frames, datetime.datetime.now(), time_step)
+    return model, scalers
+
+
+def analyze_index_pooled(model_type, index_name, ticker_frames):
+    """
+    pooled 模式：對整個指數訓練一個模型並批量預測
+    :return: [(ticker, potential, current_price, predicted_price)]
+    """
+    ticker_frames = pooled_frames(ticker_frames)
+    if not ticker_frames:
+        return []
+    with metrics.span("pooled", model=f"pooled_{model_type}", index=index_name, tickers=len(ticker_frames)):
+        model, scalers = fit_pooled_model(model_type, index_name, ticker_frames)
+        predicted = predict_pooled(model, ticker_frames, scalers)
+
+    predictions = []
+    for ticker, predicted_price in predicted.items():
+        current_price = ticker_frames[ticker]['Close'].values[-1].item()
+        potential = (predicted_price - current_price) / current_price
+        predictions.append((ticker, potential, current_price, predicted_price))
+    return predictions
+
+# 通知發送：連線在整個執行期間重複使用，失敗時以指數退避重試
+TELEGRAM_MESSAGE_LIMIT = 4096
+DISCORD_MESSAGE_LIMIT = 2000
+
+_http_session = None
+_smtp_server = None
+_rate_limit_lock = threading.Lock()
+_last_sent_at = {}
+
+
+def get_http_session():
+    """返回共用的 requests.Session，重複使用 Telegram / Discord 的 HTTP 連線"""
+    global _http_session
+    if _http_session is None:
+        _http_session = requests.Session()
+    return _http_session
+
+
+def split_message(message, limit):
+    """
+    依行拆分超過平台長度上限的訊息，單行超過上限時才強制截斷
+    :return: 每段長度都不超過 limit 的訊息列表
+    """
+    chunks, current = [], ""
+    for line in message.splitlines(keepends=True):
+        while len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if len(current) + len(line) > limit:
+            chunks.append(current)
+            current = ""
+        current += line
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _wait_for_rate_limit(sink, min_interval):
+    """同一平台兩次發送之間至少間隔 min_interval 秒"""
+    with _rate_limit_lock:
+        wait = _last_sent_at.get(sink, 0) + min_interval - time.monotonic()
+        _last_sent_at[sink] = time.monotonic() + max(wait, 0)
+    if wait > 0:
+        time.sleep(wait)
+
+
+def _retry_after(response):
+    """從 429 回應中讀取建議的等待秒數（Telegram 放在 parameters.retry_after，Discord 放在 retry_after）"""
+    try:
+        body = response.json()
+        return float(body.get("parameters", {}).get("retry_after") or body.get("retry_after"))
+    except Exception:
+        return float(response.headers.get("Retry-After", 1))
+
+
+def post_with_retry(sink, url, payload, min_interval=0.0):
+    """
+    POST JSON 並在連線錯誤、429 與 5xx 時重試
+    :return: 最後一次的 response，全部失敗時拋出最後的錯誤
+    """
+    for attempt in range(notify_max_retries + 1):
+        _wait_for_rate_limit(sink, min_interval)
+        try:
+            response = get_http_session().post(url, json=payload, timeout=30)
+        except requests.RequestException:
+            if attempt == notify_max_retries:
+                raise
+            time.sleep(notify_backoff_seconds * 2 ** attempt)
+            continue
+        if response.status_code == 429 and attempt < notify_max_retries:
+            time.sleep(_retry_after(response))
+        elif response.status_code >= 500 and attempt < notify_max_retries:
+            time.sleep(notify_backoff_seconds * 2 ** attempt)
+        else:
+            return response
+    return response
+
+
+def _get_smtp_server():
+    """返回已登入的 SMTP 連線，斷線時重新連線"""
+    global _smtp_server
+    if _smtp_server is not None:
+        try:
+            _smtp_server.noop()
+            return _smtp_server
+        except smtplib.SMTPException:
+            _smtp_server = None
+    if smtp_use_ssl:
+        server = smtplib.SMTP_SSL(smtp_server, port, timeout=30)
+    else:
+        server = smtplib.SMTP(smtp_server, port, timeout=30)
+    if sender_email and password:
+        server.login(sender_email, password)
+    _smtp_server = server
+    return server
 
-    # 使用 scaler 進行反標準化
-    predicted_close_prices = scaler.inverse_transform(full_predictions)[:, close_index]
-    return predicted_close_prices
 
 # 發送電子郵件
 def send_email(subject, body, to_emails):
@@ -354,175 +1778,902 @@ def send_email(subject, body, to_emails):
     msg['To'] = ", ".join(to_emails)
     msg['Subject'] = subject
     msg.attach(MIMEText(body, 'plain'))
-    server = smtplib.SMTP_SSL(smtp_server, port)
-    server.login(sender_email, password)
-    server.sendmail(sender_email, to_emails, msg.as_string())
-    server.quit()
+    global _smtp_server
+    for attempt in range(notify_max_retries + 1):
+        try:
+            _get_smtp_server().sendmail(sender_email, to_emails, msg.as_string())
+            return
+        except (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, OSError):
+            _smtp_server = None
+            if attempt == notify_max_retries:
+                raise
+            time.sleep(notify_backoff_seconds * 2 ** attempt)
 
 # 發送 Telegram 消息
 def send_to_telegram(message):
-    url = f"https://api.telegram.org/bot{telegram_bot_token}/sendMessage"
-    payload = {"chat_id": telegram_channel_id, "text": message, "parse_mode": "HTML"}
-    response = requests.post(url, json=payload)
-    if response.status_code != 200:
-        print(f"Telegram 發送失敗: {response.text}")
+    url = f"{telegram_api_url}/bot{telegram_bot_token}/sendMessage"
+    for chunk in split_message(message, TELEGRAM_MESSAGE_LIMIT):
+        payload = {"chat_id": telegram_channel_id, "text": chunk, "parse_mode": "HTML"}
+        response = post_with_retry("telegram", url, payload, min_interval=1.0)
+        if response.status_code != 200:
+            raise RuntimeError(f"Telegram 發送失敗: {response.status_code}, {response.text}")
 
 
 # 發送 Discord 消息
 def send_to_discord(message):
-    try:
+    for chunk in split_message(message, DISCORD_MESSAGE_LIMIT):
         payload = {
-            "content": message
-        }
-        headers = {
-            "Content-Type": "application/json"
+            "content": chunk
         }
-        response = requests.post(discord_webhook_url, json=payload, headers=headers)  # 使用全域變數
+        response = post_with_retry("discord", discord_webhook_url, payload, min_interval=0.5)  # 使用全域變數
         if response.status_code == 204:
             print("訊息已成功傳送到 Discord 頻道。")
         else:
-            print(f"傳送訊息到 Discord 時發生錯誤: {response.status_code}, {response.text}")
-    except Exception as e:
-        print(f"傳送訊息到 Discord 時發生錯誤: {str(e)}")
+            raise RuntimeError(f"傳送訊息到 Discord 時發生錯誤: {response.status_code}, {response.text}")
 
-def send_results(index_name, stock_predictions):
-    calculation_time = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    print(f"發送結果: {index_name}")
 
-    # 將結果存入 MongoDB（可選功能）
-    save_to_mongodb(index_name, stock_predictions)
+def format_prediction(stock):
+    """
+    組成一行預測結果；rank 模式的 Ensemble 預測多帶一個排名分數，排序依此分數而非潛力，
+    因此列出分數並把潛力標為各模型的平均，避免清單看起來沒有依潛力排序
+    """
+    if len(stock) > 4:
+        return (f"股票: {stock[0]}, 排名分數: {stock[4]:.2f}, 平均潛力: {stock[1]:.2%}, "
+                f"現價: {stock[2]:.2f}, 預測價: {stock[3]:.2f}\n")
+    return f"股票: {stock[0]}, 潛力: {stock[1]:.2%}, 現價: {stock[2]:.2f}, 預測價: {stock[3]:.2f}\n"
 
-    # 組裝 Email 內容
+
+def build_messages(index_name, stock_predictions, calculation_time):
+    """
+    一次組裝所有平台的訊息內容
+    :return: {"email": (subject, body), "telegram": message, "discord": message}
+    """
     email_subject = f"每日潛力股分析DAVID888 - {index_name} - 運算時間: {calculation_time}"
     email_body = f"運算日期和時間: {calculation_time}\n\n指數: {index_name}\n"
-    for key, predictions in stock_predictions.items():
-        email_body += f"\n{key}:\n"
-        for stock in predictions:
-            email_body += f"股票: {stock[0]}, 潛力: {stock[1]:.2%}, 現價: {stock[2]:.2f}, 預測價: {stock[3]:.2f}\n"
-    send_email(email_subject, email_body, to_emails)
-
-    # 組裝 Telegram 內容
     telegram_message = f"<b>每日潛力股分析</b>\n運算日期和時間: <b>{calculation_time}</b>\n\n指數: <b>{index_name}</b>\n"
-    for key, predictions in stock_predictions.items():
-        telegram_message += f"<b>{key}:</b>\n"
-        for stock in predictions:
-            telegram_message += f"股票: {stock[0]}, 潛力: {stock[1]:.2%}, 現價: {stock[2]:.2f}, 預測價: {stock[3]:.2f}\n"
-    send_to_telegram(telegram_message)
-
-    # 組裝 Discord 內容
     discord_message = f"**每日潛力股分析**\n運算日期和時間: **{calculation_time}**\n\n指數: **{index_name}**\n"
     for key, predictions in stock_predictions.items():
-        discord_message += f"**{key}:**\n"
-        for stock in predictions:
-            discord_message += f"股票: {stock[0]}, 潛力: {stock[1]:.2%}, 現價: {stock[2]:.2f}, 預測價: {stock[3]:.2f}\n"
-    send_to_discord(discord_message)  # 不再傳入 webhook_url
+        lines = "".join(format_prediction(stock) for stock in predictions)
+        email_body += f"\n{key}:\n{lines}"
+        telegram_message += f"<b>{key}:</b>\n{lines}"
+        discord_message += f"**{key}:**\n{lines}"
+    return {
+        "email": (email_subject, email_body),
+        "telegram": telegram_message,
+        "discord": discord_message,
+    }
 
 
+# 每個通知平台各自一個單執行緒的佇列：平台之間並行，同一平台內保持發送順序
+_notify_executors = {}
+_pending_notifications = []
 
-# # 股票分析函數
-def get_top_and_bottom_10_potential_stocks(period, selected_indices):
-    results = {}
-    index_stock_map = {
-        "台灣50": get_tw0050_stocks(),
-        "台灣中型100": get_tw0051_stocks(),
-        "SP500": get_sp500_stocks(),
-        "NASDAQ": get_nasdaq_stocks(),
-        "費城半導體": get_sox_stocks(),
-        "道瓊": get_dji_stocks()
-    }
 
-    for index_name, stock_list in index_stock_map.items():
-        if index_name not in selected_indices:
-            continue
+def _dispatch(sink, func, *args):
+    if sink not in _notify_executors:
+        _notify_executors[sink] = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"notify-{sink}")
+
+    def run():
+        # 返回是否成功送出，失敗已在此記錄，不再向呼叫端拋出
+        try:
+            with metrics.span("notify", sink=sink):
+                func(*args)
+            return True
+        except Exception as e:
+            metrics.incr("notify_failed", sink=sink)
+            print(f"⚠️ {sink} 發送失敗: {str(e)}")
+            return False
 
-        print(f"處理指數: {index_name}")
-        lstm_predictions = []
-        prophet_predictions = []
-        transformer_predictions = []
+    future = _notify_executors[sink].submit(run)
+    _pending_notifications.append(future)
+    return future
+
+
+def send_results(index_name, stock_predictions):
+    """
+    非同步發送單一指數的結果，立即返回，可用 flush_notifications() 等待全部送出
+    未設置的平台（例如沒有 TELEGRAM_BOT_TOKEN）會被略過
+    :return: 各平台的 Future，結果為是否成功送出
+    """
+    calculation_time = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    print(f"發送結果: {index_name}")
+    messages = build_messages(index_name, stock_predictions, calculation_time)
 
-        for ticker in stock_list:
-            lstm_data = get_stock_data(ticker, period)
-            if len(lstm_data) >= 60:
+    # 將結果存入 MongoDB（可選功能）
+    futures = []
+    if mongo_uri:
+        futures.append(_dispatch("mongodb", save_to_mongodb, index_name, stock_predictions))
+    if smtp_server and to_emails:
+        futures.append(_dispatch("email", send_email, *messages["email"], to_emails))
+    if telegram_bot_token and telegram_channel_id:
+        futures.append(_dispatch("telegram", send_to_telegram, messages["telegram"]))
+    if discord_webhook_url:
+        futures.append(_dispatch("discord", send_to_discord, messages["discord"]))  # 不再傳入 webhook_url
+    return futures
+
+
+def when_delivered(futures, callback):
+    """所有平台都成功送出後呼叫 callback（在最後完成的通知執行緒中）；任一平台失敗時不呼叫"""
+    if not futures:
+        callback()
+        return
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] > 0:
+                return
+        if all(future.exception() is None and future.result() for future in futures):
+            callback()
+
+    for future in futures:
+        future.add_done_callback(done)
+
+
+def flush_notifications():
+    """等待所有已排程的通知送出，並關閉共用連線"""
+    global _smtp_server, _mongo_client, _history_db
+    for future in _pending_notifications:
+        future.result()
+    _pending_notifications.clear()
+    if _smtp_server is not None:
+        try:
+            _smtp_server.quit()
+        except smtplib.SMTPException:
+            pass
+        _smtp_server = None
+    if _mongo_client is not None:
+        _mongo_client.close()
+        _mongo_client = None
+    if _history_db is not None:
+        _history_db.close()
+        _history_db = None
+
+
+
+# 單一股票分析（並行運算的最小工作單位）
+def analyze_ticker(ticker, lstm_data, transformer_data=None, models=("lstm", "transformer", "prophet")):
+    """
+    對單一股票執行所有啟用的模型，每個模型的失敗只影響自身
+    :param ticker: 股票代碼
+    :param lstm_data: LSTM / Prophet 使用的數據
+    :param transformer_data: Transformer 使用的數據
+    :param models: 要執行的模型，未啟用的模型會被忽略
+    :return: {模型名稱: (ticker, potential, current_price, predicted_price)}
+    """
+    predictions = {}
+    with metrics.span("ticker", ticker=ticker):
+        if "lstm" in models:
+            if len(lstm_data) < 60:
+                metrics.incr("tickers_skipped", model="lstm")
+            else:
                 try:
-                    X_train, y_train, lstm_scaler = prepare_data(lstm_data)
-                    lstm_model = train_lstm_model(X_train, y_train)
-                    lstm_predicted_prices = predict_stock(lstm_model, lstm_data, lstm_scaler)
+                    with metrics.span("model", model="lstm"):
+                        lstm_model, lstm_scaler = fit_ticker_model("lstm", ticker, lstm_data)
+                        lstm_model = to_inference_model("lstm", ticker, lstm_model)
+                        lstm_predicted_prices = predict_stock(lstm_model, lstm_data, lstm_scaler, last_only=True)
                     lstm_current_price = lstm_data['Close'].values[-1].item()
                     lstm_predicted_price = float(lstm_predicted_prices[-1])
                     lstm_potential = (lstm_predicted_price - lstm_current_price) / lstm_current_price
-                    lstm_predictions.append((ticker, lstm_potential, lstm_current_price, lstm_predicted_price))
+                    predictions["lstm"] = (ticker, lstm_potential, lstm_current_price, lstm_predicted_price)
                 except Exception as e:
+                    metrics.incr("tickers_failed", model="lstm")
                     print(f"LSTM 預測失敗: {ticker}, 錯誤: {str(e)}")
 
-            if use_transformer:
-                transformer_data = get_stock_data(ticker, period=transformer_period)
-                if len(transformer_data) >= 60:
-                    try:
-                        X_train, y_train, transformer_scaler = prepare_data(transformer_data)
-                        input_shape = (X_train.shape[1], X_train.shape[2])
-                        transformer_model = train_transformer_model(X_train, y_train, input_shape)
-                        transformer_predicted_prices = predict_transformer(transformer_model, transformer_data, transformer_scaler)
-                        transformer_current_price = transformer_data['Close'].values[-1].item()
-                        transformer_predicted_price = float(transformer_predicted_prices[-1])
-                        transformer_potential = (transformer_predicted_price - transformer_current_price) / transformer_current_price
-                        transformer_predictions.append((ticker, transformer_potential, transformer_current_price, transformer_predicted_price))
-                    except Exception as e:
-                        print(f"Transformer 預測失敗: {ticker}, 錯誤: {str(e)}")
-
-            if use_prophet:
+        if "transformer" in models and use_transformer:
+            if transformer_data is None or len(transformer_data) < 60:
+                metrics.incr("tickers_skipped", model="transformer")
+            elif deadline_near():
+                metrics.incr("tickers_skipped", model="transformer", reason="deadline")
+                print(f"接近執行截止時間，略過 Transformer: {ticker}")
+            else:
                 try:
-                    prophet_model = train_prophet_model(lstm_data)
+                    with metrics.span("model", model="transformer"):
+                        transformer_model, transformer_scaler = fit_ticker_model("transformer", ticker, transformer_data)
+                        transformer_model = to_inference_model("transformer", ticker, transformer_model)
+                        transformer_predicted_prices = predict_transformer(transformer_model, transformer_data, transformer_scaler, last_only=True)
+                    transformer_current_price = transformer_data['Close'].values[-1].item()
+                    transformer_predicted_price = float(transformer_predicted_prices[-1])
+                    transformer_potential = (transformer_predicted_price - transformer_current_price) / transformer_current_price
+                    predictions["transformer"] = (ticker, transformer_potential, transformer_current_price, transformer_predicted_price)
+                except Exception as e:
+                    metrics.incr("tickers_failed", model="transformer")
+                    print(f"Transformer 預測失敗: {ticker}, 錯誤: {str(e)}")
+
+        if "prophet" in models and use_prophet:
+            try:
+                with metrics.span("model", model="prophet"):
+                    prophet_model = train_prophet_model(lstm_data, ticker)
                     forecast = predict_with_prophet(prophet_model, lstm_data)
-                    prophet_current_price = lstm_data['Close'].values[-1].item()
-                    prophet_predicted_price = float(forecast['yhat'].iloc[-1])
-                    prophet_potential = (prophet_predicted_price - prophet_current_price) / prophet_current_price
-                    prophet_predictions.append((ticker, prophet_potential, prophet_current_price, prophet_predicted_price))
+                prophet_current_price = lstm_data['Close'].values[-1].item()
+                prophet_predicted_price = float(forecast['yhat'].iloc[-1])
+                prophet_potential = (prophet_predicted_price - prophet_current_price) / prophet_current_price
+                predictions["prophet"] = (ticker, prophet_potential, prophet_current_price, prophet_predicted_price)
+            except Exception as e:
+                metrics.incr("tickers_failed", model="prophet")
+                print(f"Prophet 預測失敗: {ticker}, 錯誤: {str(e)}")
+
+    for model in predictions:
+        metrics.incr("tickers_ok", model=model)
+    return predictions
+
+
+def _analyze_ticker_job(*job):
+    """子進程入口：返回分析結果、這個工作記錄的指標與資源用量，由主進程合併"""
+    metrics.drain()
+    start = time.perf_counter()
+    predictions = analyze_ticker(*job)
+    usage = {"seconds": time.perf_counter() - start, "rss_mb": peak_rss_mb()}
+    return predictions, metrics.drain(), usage
+
+
+def _init_worker(num_threads, deadline_at=None):
+    """子進程初始化：限制 TensorFlow 執行緒數，避免多個進程互相搶佔 CPU，並沿用主進程的執行截止時間"""
+    global run_deadline_at
+    run_deadline_at = deadline_at
+    tf = lazy_import("tensorflow")
+    tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(num_threads)
+
+
+def create_executor():
+    """
+    依 PARALLEL_WORKERS 建立進程池，workers <= 1 時返回 None（在主進程中依序運算）
+    每個子進程的 TensorFlow 執行緒數為 TF_THREADS_PER_WORKER，默認平均分配 CPU 核心
+    """
+    if parallel_workers <= 1:
+        return None
+    num_threads = tf_threads_per_worker or max(1, (os.cpu_count() or 1) // parallel_workers)
+    print(f"啟動 {parallel_workers} 個運算進程，每個進程使用 {num_threads} 個執行緒")
+    # TensorFlow 在 fork 之後不安全，統一使用 spawn
+    return ProcessPoolExecutor(
+        max_workers=parallel_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(num_threads, run_deadline_at),
+    )
+
+
+# 成本模型：依數據長度與過去的實測耗時估計每個工作的耗時與記憶體
+class CostModel:
+    """
+    有實測記錄的 (股票, 模型) 沿用其耗時並依數據長度等比例調整，其他的以該模型每行數據的平均耗時估計
+    實測值以指數移動平均更新，保存到 COST_MODEL_FILE 後下次執行的估計會更準確
+    """
+    DEFAULT_SECONDS_PER_ROW = {"lstm": 0.05, "transformer": 0.2, "prophet": 0.01}  # 沒有任何實測記錄時使用
+    SMOOTHING = 0.3  # 新實測值的權重
+
+    def __init__(self, path=None):
+        self.path = path
+        self.models = {}   # {model: {"seconds_per_row": float, "rss_mb": float}}
+        self.tickers = {}  # {"ticker|model": {"seconds": float, "rows": int}}
+        if path and os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    saved = json.load(f)
+                self.models, self.tickers = saved["models"], saved["tickers"]
+            except (OSError, ValueError, KeyError) as e:
+                print(f"讀取成本模型失敗，使用默認估計: {str(e)}")
+
+    @staticmethod
+    def job_rows(job):
+        """返回 {模型名稱: 數據行數}，只包含這個工作實際會執行的模型"""
+        _, lstm_data, transformer_data, models = job
+        enabled = {"lstm": True, "transformer": use_transformer, "prophet": use_prophet}
+        rows = {}
+        for model in models:
+            data = transformer_data if model == "transformer" else lstm_data
+            if enabled.get(model) and data is not None and len(data) > 0:
+                rows[model] = len(data)
+        return rows
+
+    def _smooth(self, previous, value):
+        return value if previous is None else (1 - self.SMOOTHING) * previous + self.SMOOTHING * value
+
+    def _estimate(self, ticker, model, rows):
+        measured = self.tickers.get(f"{ticker}|{model}")
+        if measured is not None:
+            return measured["seconds"] * rows / max(measured["rows"], 1)
+        rate = self.models.get(model, {}).get("seconds_per_row", self.DEFAULT_SECONDS_PER_ROW.get(model, 0.05))
+        return rate * rows
+
+    def estimate(self, job):
+        """工作的預估耗時（秒）"""
+        return sum(self._estimate(job[0], model, rows) for model, rows in self.job_rows(job).items())
+
+    def memory(self, job):
+        """執行工作的進程的預估 peak RSS (MB)，沒有實測記錄時返回 0"""
+        return max((self.models.get(model, {}).get("rss_mb", 0.0) for model in self.job_rows(job)), default=0.0)
+
+    def observe(self, job, seconds, rss_mb=None):
+        """以實測耗時更新估計，一個工作包含多個模型時依各模型的預估耗時比例分攤"""
+        rows = self.job_rows(job)
+        estimates = {model: self._estimate(job[0], model, n) for model, n in rows.items()}
+        total = sum(estimates.values())
+        for model, n in rows.items():
+            share = seconds * (estimates[model] / total if total > 0 else 1 / len(rows))
+            self.tickers[f"{job[0]}|{model}"] = {"seconds": self._smooth(
+                estimates[model] if f"{job[0]}|{model}" in self.tickers else None, share), "rows": n}
+            stats = self.models.setdefault(model, {})
+            stats["seconds_per_row"] = self._smooth(stats.get("seconds_per_row"), share / n)
+            if rss_mb:
+                stats["rss_mb"] = self._smooth(stats.get("rss_mb"), rss_mb)
+
+    def save(self):
+        if not self.path:
+            return
+        try:
+            # 先寫入暫存檔再替換，中斷時不會留下不完整的檔案
+            with open(f"{self.path}.tmp", "w", encoding="utf-8") as f:
+                json.dump({"models": self.models, "tickers": self.tickers}, f, ensure_ascii=False)
+            os.replace(f"{self.path}.tmp", self.path)
+        except OSError as e:
+            print(f"保存成本模型失敗: {str(e)}")
+
+
+def run_ticker_jobs(executor, jobs, cost_model=None, groups=None, on_start=None):
+    """
+    執行一批股票分析工作，依完成順序產出結果
+    同一組內的工作依預估耗時由長到短開始，避免最後只剩一個長工作在執行；組與組之間維持原本的順序，
+    前面的指數不必等後面指數的長工作完成；設置 RUN_DEADLINE_SECONDS 時，
+    預估耗時超過剩餘時間的工作不再開始；設置 RUN_MEMORY_BUDGET_MB 時，同時執行的工作的預估記憶體合計不超過預算
+    :param executor: create_executor() 的返回值，None 時依序運算
+    :param jobs: [(ticker, lstm_data, transformer_data, models)]
+    :param cost_model: CostModel，執行完畢後以實測耗時更新並保存，None 時使用默認估計
+    :param groups: 每個工作所屬組的序號（例如股票首次出現的指數），None 時所有工作為同一組
+    :param on_start: 每個工作開始運算時以其在 jobs 中的序號呼叫
+    :return: 產出 (ticker, models, analyze_ticker 的結果)，工作崩潰或因截止時間略過時結果為 None
+    """
+    cost_model = cost_model or CostModel()
+    estimates = [cost_model.estimate(job) for job in jobs]
+    groups = groups or [0] * len(jobs)
+    queue = deque(sorted(range(len(jobs)), key=lambda i: (groups[i], -estimates[i])))
+
+    def over_deadline(i):
+        remaining = run_seconds_remaining()
+        if remaining is None or estimates[i] <= remaining:
+            return False
+        metrics.incr("jobs_skipped", reason="deadline")
+        print(f"預估耗時 {estimates[i]:.1f}s 超過剩餘時間，略過: {jobs[i][0]} ({', '.join(jobs[i][3])})")
+        return True
+
+    try:
+        if executor is None:
+            for i in queue:
+                ticker, models = jobs[i][0], jobs[i][3]
+                if over_deadline(i):
+                    yield ticker, models, None
+                    continue
+                if on_start is not None:
+                    on_start(i)
+                start = time.perf_counter()
+                predictions = analyze_ticker(*jobs[i])
+                cost_model.observe(jobs[i], time.perf_counter() - start)
+                yield ticker, models, predictions
+            return
+
+        running = {}
+        while queue or running:
+            # 進程池只保留與進程數相同的工作，其餘的留在佇列中，才能在開始前檢查截止時間與記憶體預算
+            while queue and len(running) < parallel_workers:
+                i = queue[0]
+                if over_deadline(i):
+                    queue.popleft()
+                    yield jobs[i][0], jobs[i][3], None
+                    continue
+                memory = sum(cost_model.memory(jobs[j]) for j in running.values()) + cost_model.memory(jobs[i])
+                if running and run_memory_budget_mb > 0 and memory > run_memory_budget_mb:
+                    metrics.incr("jobs_deferred", reason="memory")
+                    break
+                queue.popleft()
+                if on_start is not None:
+                    on_start(i)
+                running[executor.submit(_analyze_ticker_job, *jobs[i])] = i
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = jobs[running.pop(future)]
+                ticker, models = job[0], job[3]
+                try:
+                    predictions, worker_metrics, usage = future.result()
                 except Exception as e:
-                    print(f"Prophet 預測失敗: {ticker}, 錯誤: {str(e)}")
+                    # 子進程崩潰等錯誤只影響該股票，predictions 為 None 表示沒有完成
+                    metrics.incr("tickers_crashed")
+                    print(f"股票運算失敗: {ticker}, 錯誤: {str(e)}")
+                    yield ticker, models, None
+                    continue
+                metrics.merge(worker_metrics)
+                cost_model.observe(job, usage["seconds"], usage["rss_mb"])
+                yield ticker, models, predictions
+    finally:
+        cost_model.save()
 
-        stock_predictions = {
-            "🥇 前十名 LSTM 🧠": sorted(lstm_predictions, key=lambda x: x[1], reverse=True)[:10],
-            "📉 後十名 LSTM 🧠": sorted(lstm_predictions, key=lambda x: x[1])[:10],
-        }
 
-        if use_prophet and prophet_predictions:
-            stock_predictions.update({
-                "🚀 前十名 Prophet 🔮": sorted(prophet_predictions, key=lambda x: x[1], reverse=True)[:10],
-                "⛔ 後十名 Prophet 🔮": sorted(prophet_predictions, key=lambda x: x[1])[:10],
-            })
+# 排名：以有界 heap 持續維護前十名與後十名
+class TopBottomTracker:
+    """
+    逐筆加入預測結果並維護前 n 名與後 n 名，不需保留或排序全部結果
+    潛力相同時以加入時指定的 order 較小者優先，與 sorted 的穩定排序結果一致
+    """
 
-        if use_transformer and transformer_predictions:
-            stock_predictions.update({
-                "🚀 前十名 Transformer 🔄": sorted(transformer_predictions, key=lambda x: x[1], reverse=True)[:10],
-                "⛔ 後十名 Transformer 🔄": sorted(transformer_predictions, key=lambda x: x[1])[:10],
-            })
+    def __init__(self, n=10):
+        self.n = n
+        self._top = []     # (potential, -order, prediction)，heap 頂端為前 n 名中最差的一筆
+        self._bottom = []  # (-potential, -order, prediction)，heap 頂端為後 n 名中最好的一筆
+        self.count = 0
 
-        if stock_predictions:
-            results[index_name] = stock_predictions
+    def add(self, prediction, order, score=None):
+        """:param score: 排名依據，默認為 prediction 的潛力"""
+        self.count += 1
+        score = prediction[1] if score is None else score
+        for heap, key in ((self._top, score), (self._bottom, -score)):
+            item = (key, -order, prediction)
+            if len(heap) < self.n:
+                heapq.heappush(heap, item)
+            elif item[:2] > heap[0][:2]:
+                heapq.heapreplace(heap, item)
+
+    def top(self):
+        return [item[2] for item in sorted(self._top, key=lambda item: (-item[0], -item[1]))]
+
+    def bottom(self):
+        return [item[2] for item in sorted(self._bottom, key=lambda item: (-item[0], -item[1]))]
+
+
+MODEL_SECTIONS = {
+    "lstm": ("🥇 前十名 LSTM 🧠", "📉 後十名 LSTM 🧠"),
+    "prophet": ("🚀 前十名 Prophet 🔮", "⛔ 後十名 Prophet 🔮"),
+    "transformer": ("🚀 前十名 Transformer 🔄", "⛔ 後十名 Transformer 🔄"),
+    "ensemble": ("🏆 前十名 Ensemble 🤝", "🧊 後十名 Ensemble 🤝"),
+}
 
+
+def ensemble_predictions(index_predictions, method="rank", weights=None):
+    """
+    將同一指數內各模型的預測合併為一個分數
+    :param index_predictions: {ticker: {model: (ticker, potential, current_price, predicted_price)}}
+    :param method: rank 為各模型在指數內百分位排名的加權平均 (0~1)，weighted 為潛力的加權平均
+    :param weights: {model: weight}，未列出的模型權重為 1，權重為 0 的模型不參與
+    :return: [(prediction, score)]，prediction 的潛力與預測價為各模型的加權平均，score 為排名依據
+    """
+    weights = weights or {}
+    ranks = {}
+    if method == "rank":
+        for model in {model for predictions in index_predictions.values() for model in predictions}:
+            potentials = pd.Series({ticker: predictions[model][1] for ticker, predictions in index_predictions.items()
+                                    if model in predictions})
+            ranks[model] = potentials.rank(pct=True)
+
+    results = []
+    for ticker, predictions in index_predictions.items():
+        models = [model for model in predictions if weights.get(model, 1.0) > 0]
+        if not models:
+            continue
+        model_weights = np.array([weights.get(model, 1.0) for model in models])
+        potential = float(np.dot(model_weights, [predictions[model][1] for model in models]) / model_weights.sum())
+        current_price = predictions[models[0]][2]
+        if method == "rank":
+            score = float(np.dot(model_weights, [ranks[model][ticker] for model in models]) / model_weights.sum())
+        else:
+            score = potential
+        results.append(((ticker, potential, current_price, current_price * (1 + potential)), score))
     return results
 
 
+def build_stock_predictions(trackers):
+    """將各模型的排名組成 stock_predictions（LSTM 永遠列出，其他模型有結果時才列出）"""
+    stock_predictions = {}
+    for model, (top_key, bottom_key) in MODEL_SECTIONS.items():
+        tracker = trackers.get(model)
+        if tracker is None or (model != "lstm" and tracker.count == 0):
+            continue
+        stock_predictions[top_key] = tracker.top()
+        stock_predictions[bottom_key] = tracker.bottom()
+    return stock_predictions
+
+
+# 執行檢查點：中斷後可從最後完成的股票繼續
+class RunCheckpoint:
+    """
+    以 JSON lines 逐筆追加記錄已完成的工作單位、pooled 模型結果與已發送的指數
+    設定（日期、區間、指數與模型開關）不同時視為新的執行，舊記錄會被捨棄
+    """
+
+    def __init__(self, path, config, run_id=None):
+        self.path = path
+        self.config = config
+        self.run_id = run_id  # 續跑時沿用原本的 run_id
+        self.tickers = {}  # {ticker: predictions}，同一檔股票在所有指數中共用
+        self.done = set()  # {(ticker, model)}，包含沒有產出預測（失敗或略過）的模型
+        self.pooled = {}   # {(index_name, model): [prediction]}
+        self.sent = set()
+        self._lock = threading.Lock()  # mark_sent 在通知執行緒中呼叫
+        if self._load():
+            print(f"從檢查點繼續執行: {path}")
+        else:
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(json.dumps({"type": "run", "config": config, "run_id": run_id}, ensure_ascii=False) + "\n")
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                records = [json.loads(line) for line in f if line.strip()]
+        except (OSError, ValueError):
+            return False
+        if not records or records[0].get("config") != self.config:
+            return False
+        self.run_id = records[0].get("run_id", self.run_id)
+        for record in records[1:]:
+            if record["type"] == "ticker":
+                predictions = {model: tuple(p) for model, p in record["predictions"].items()}
+                self._add_ticker(record["ticker"], record["models"], predictions)
+            elif record["type"] == "pooled":
+                self.pooled[(record["index"], record["model"])] = [tuple(p) for p in record["predictions"]]
+            elif record["type"] == "sent":
+                self.sent.add(record["index"])
+        return True
+
+    def _append(self, record):
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _add_ticker(self, ticker, models, predictions):
+        self.tickers.setdefault(ticker, {}).update(predictions)
+        self.done.update((ticker, model) for model in models)
+
+    def is_done(self, ticker, models):
+        return all((ticker, model) in self.done for model in models)
+
+    def record_ticker(self, ticker, models, predictions):
+        """記錄一個工作單位（一檔股票的一組模型）已完成"""
+        self._add_ticker(ticker, models, predictions)
+        self._append({"type": "ticker", "ticker": ticker, "models": list(models), "predictions": predictions})
+
+    def record_pooled(self, index_name, model, predictions):
+        self.pooled[(index_name, model)] = predictions
+        self._append({"type": "pooled", "index": index_name, "model": model, "predictions": predictions})
+
+    def mark_sent(self, index_name):
+        """記錄指數的結果已送達所有平台，應在通知成功之後才呼叫"""
+        self.sent.add(index_name)
+        self._append({"type": "sent", "index": index_name})
+
+    def remove(self):
+        """整個執行完成後刪除檢查點"""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def get_index_stock_map():
+    return {
+        "台灣50": get_tw0050_stocks(),
+        "台灣中型100": get_tw0051_stocks(),
+        "SP500": get_sp500_stocks(),
+        "NASDAQ": get_nasdaq_stocks(),
+        "費城半導體": get_sox_stocks(),
+        "道瓊": get_dji_stocks()
+    }
+
+
+def plan_universe(selected_indices):
+    """
+    合併所選指數的成分股，重疊的股票只保留一份
+    :return: (universe, members)；universe 為依首次出現順序排列的不重複股票，members 為 {index_name: 去重後的成分股}
+    """
+    members = {
+        index_name: list(dict.fromkeys(stock_list))
+        for index_name, stock_list in get_index_stock_map().items()
+        if index_name in selected_indices
+    }
+    universe = list(dict.fromkeys(ticker for stock_list in members.values() for ticker in stock_list))
+    return universe, members
+
+
+def iter_index_results(period, selected_indices, checkpoint=None):
+    """
+    串流式分析：所有指數的成分股合併去重後每檔只運算一次，結果分發到所屬的每個指數
+    每完成一個工作單位產出一次，指數的所有成分股都完成後立即產出該指數的排名
+    :param checkpoint: RunCheckpoint，提供時會跳過已完成的工作單位與已發送的指數
+    :return: 產出 ("ticker", ticker, predictions)、("index_model", index_name, model, predictions)
+             或 ("index", index_name, stock_predictions)；index_model 為只屬於單一指數的預測（pooled 模型與 Ensemble）
+    """
+    universe, members = plan_universe(selected_indices)
+    if checkpoint is not None:
+        for index_name in [name for name in members if name in checkpoint.sent]:
+            print(f"略過已完成的指數: {index_name}")
+            del members[index_name]
+        universe = [ticker for ticker in universe if any(ticker in stock_list for stock_list in members.values())]
+    if not members:
+        return
+    print(f"處理指數: {', '.join(members)}，共 {len(universe)} 檔不重複股票")
+
+    # 所有股票只下載一次，LSTM 與 Transformer 的區間都從同一份序列切出
+    data_period = longest_period([period, transformer_period] if use_transformer else [period])
+    universe_data = get_index_stock_data(universe, data_period)
+    lstm_frames, transformer_frames = {}, {}
+    for ticker in universe:
+        ticker_data = universe_data.get(ticker, pd.DataFrame())
+        lstm_frames[ticker] = slice_period(ticker_data, period)
+        if use_transformer:
+            transformer_frames[ticker] = slice_period(ticker_data, transformer_period)
+
+    ticker_indices = {ticker: [name for name, stock_list in members.items() if ticker in stock_list] for ticker in universe}
+    order = {name: {ticker: i for i, ticker in enumerate(stock_list)} for name, stock_list in members.items()}
+    trackers = {name: {model: TopBottomTracker() for model in MODEL_SECTIONS} for name in members}
+
+    ticker_predictions = {}  # Ensemble 需要每檔股票所有模型的預測
+    index_started = {}  # 每個指數第一個成分股工作開始的時間，index 區段從此計時
+
+    def add_predictions(ticker, predictions):
+        if use_ensemble:
+            ticker_predictions.setdefault(ticker, {}).update(predictions)
+        for index_name in ticker_indices[ticker]:
+            for model, prediction in predictions.items():
+                trackers[index_name][model].add(prediction, order[index_name][ticker])
+
+    def complete(index_name):
+        # 成分股都已在檢查點或前面的指數中完成時，只計算 pooled 與 Ensemble 的時間
+        started = index_started.get(index_name, time.perf_counter())
+        index_predictions = {ticker: dict(ticker_predictions.get(ticker, {})) for ticker in members[index_name]}
+        # pooled 模型依賴整個指數的成分股，無法跨指數共用，在指數完成時才訓練
+        if pooled_training:
+            pooled_jobs = [("lstm", lstm_frames)]
+            if use_transformer and not deadline_near():
+                pooled_jobs.append(("transformer", transformer_frames))
+            for model, frames in pooled_jobs:
+                predictions = checkpoint.pooled.get((index_name, model)) if checkpoint is not None else None
+                if predictions is None:
+                    try:
+                        predictions = analyze_index_pooled(model, index_name, {t: frames[t] for t in members[index_name]})
+                    except Exception as e:
+                        print(f"{model} pooled 預測失敗: {index_name}, 錯誤: {str(e)}")
+                        continue
+                    if checkpoint is not None:
+                        checkpoint.record_pooled(index_name, model, predictions)
+                for prediction in predictions:
+                    trackers[index_name][model].add(prediction, order[index_name][prediction[0]])
+                    index_predictions[prediction[0]][model] = prediction
+                yield "index_model", index_name, model, predictions
+        # Ensemble 只合併已算出的預測，不需要額外下載或訓練
+        if use_ensemble:
+            combined = ensemble_predictions(index_predictions, ensemble_method, ensemble_weights)
+            for prediction, score in combined:
+                # rank 模式的排名依據不是潛力，把分數附在預測後面，訊息中才能顯示排序的依據
+                ranked = prediction + (score,) if ensemble_method == "rank" else prediction
+                trackers[index_name]["ensemble"].add(ranked, order[index_name][prediction[0]], score)
+            yield "index_model", index_name, "ensemble", [prediction for prediction, _ in combined]
+        metrics.record("index", time.perf_counter() - started, index=index_name, tickers=len(members[index_name]))
+        yield "index", index_name, build_stock_predictions(trackers[index_name])
+
+    if checkpoint is not None:
+        for ticker, predictions in checkpoint.tickers.items():
+            if ticker in ticker_indices:
+                add_predictions(ticker, predictions)
+
+    # Prophet 為獨立的工作單位，在進程池中與 LSTM / Transformer 同時運算，開始順序由 run_ticker_jobs 依預估耗時決定
+    # 使用進程池時 LSTM 與 Transformer 也各自為一個工作單位，同一檔股票的模型可同時運算
+    # pooled 模式下 LSTM / Transformer 在主進程中對每個指數各訓練一次，只剩 Prophet 逐檔運算
+    units = [("prophet",)] if use_prophet else []
+    if not pooled_training:
+        if parallel_workers > 1 and use_transformer:
+            units += [("transformer",), ("lstm",)]
+        else:
+            units.append(("lstm", "transformer"))
+    # 同一檔股票的所有工作單位排在一起，universe 依股票首次出現的指數排序，前面的指數可以先完成並發送
+    jobs, pending = [], {}
+    for ticker in universe:
+        for models in units:
+            if checkpoint is not None and checkpoint.is_done(ticker, models):
+                continue
+            transformer_data = transformer_frames.get(ticker) if "transformer" in models else None
+            jobs.append((ticker, lstm_frames[ticker], transformer_data, models))
+            pending[ticker] = pending.get(ticker, 0) + 1
+    remaining = {name: {ticker for ticker in stock_list if ticker in pending} for name, stock_list in members.items()}
+    cost_model = CostModel(cost_model_file)
+    if jobs:
+        estimated = sum(cost_model.estimate(job) for job in jobs)
+        print(f"共 {len(jobs)} 個工作，預估運算時間 {estimated / max(parallel_workers, 1):.0f}s")
+    metrics.incr("universe_tickers", len(universe))
+    metrics.incr("index_memberships", sum(len(stock_list) for stock_list in members.values()))
+
+    executor = create_executor() if jobs else None
+    try:
+        for index_name in members:
+            if not remaining[index_name]:
+                yield from complete(index_name)
+
+        index_position = {name: i for i, name in enumerate(members)}
+        groups = [index_position[ticker_indices[job[0]][0]] for job in jobs]
+
+        def job_started(i):
+            for index_name in ticker_indices[jobs[i][0]]:
+                index_started.setdefault(index_name, time.perf_counter())
+
+        for ticker, models, predictions in run_ticker_jobs(executor, jobs, cost_model, groups, job_started):
+            if predictions is not None:
+                add_predictions(ticker, predictions)
+                if checkpoint is not None:
+                    checkpoint.record_ticker(ticker, models, predictions)
+                yield "ticker", ticker, predictions
+
+            pending[ticker] -= 1
+            if pending[ticker] > 0:
+                continue
+            for index_name in ticker_indices[ticker]:
+                remaining[index_name].discard(ticker)
+                if not remaining[index_name]:
+                    yield from complete(index_name)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+# # 股票分析函數
+def get_top_and_bottom_10_potential_stocks(period, selected_indices):
+    results = {}
+    for event in iter_index_results(period, selected_indices):
+        if event[0] == "index":
+            _, index_name, stock_predictions = event
+            results[index_name] = stock_predictions
+    return results
+
+
+
+# 設定檢查：在下載數據與匯入模型套件之前執行
+def validate_config():
+    """
+    檢查 .env 設定的格式與組合
+    :return: 錯誤訊息列表，空列表表示設定有效
+    """
+    errors = list(config_errors)
+    if smtp_server and not (sender_email and password and to_emails):
+        errors.append("設置 SMTP_SERVER 時需要同時設置 SENDER_EMAIL、EMAIL_PASSWORD 與 TO_EMAILS")
+    if bool(telegram_bot_token) != bool(telegram_channel_id):
+        errors.append("TELEGRAM_BOT_TOKEN 與 TELEGRAM_CHANNEL_ID 需要同時設置")
+    try:
+        period_start(transformer_period)
+    except ValueError as e:
+        errors.append(f"TRANSFORMER_PERIOD: {str(e)}")
+    if inference_backend not in ("keras", "tflite"):
+        errors.append(f"INFERENCE_BACKEND 必須是 keras 或 tflite: {inference_backend!r}")
+    if tflite_quantization not in TFLITE_QUANTIZATIONS:
+        errors.append(f"TFLITE_QUANTIZATION 必須是 {' / '.join(TFLITE_QUANTIZATIONS)}: {tflite_quantization!r}")
+    if ensemble_method not in ("rank", "weighted"):
+        errors.append(f"ENSEMBLE_METHOD 必須是 rank 或 weighted: {ensemble_method!r}")
+    unknown_models = set(ensemble_weights) - {"lstm", "transformer", "prophet"}
+    if unknown_models:
+        errors.append(f"ENSEMBLE_WEIGHTS 包含未知的模型: {', '.join(sorted(unknown_models))}")
+    if not 0 <= validation_split < 1:
+        errors.append(f"VALIDATION_SPLIT 必須介於 0 與 1 之間: {validation_split}")
+    for name, value in (("SMTP_PORT", port), ("PARALLEL_WORKERS", parallel_workers), ("MAX_EPOCHS", max_epochs),
+                        ("HISTORY_BATCH_SIZE", history_batch_size)):
+        if value < 1:
+            errors.append(f"{name} 必須大於 0: {value}")
+    for name, value in (("NOTIFY_MAX_RETRIES", notify_max_retries), ("NOTIFY_BACKOFF_SECONDS", notify_backoff_seconds),
+                        ("POOLED_EMBEDDING_DIM", pooled_embedding_dim), ("FINETUNE_EPOCHS", finetune_epochs),
+                        ("TF_THREADS_PER_WORKER", tf_threads_per_worker), ("EARLY_STOPPING_PATIENCE", early_stopping_patience),
+                        ("FIT_TIME_BUDGET_SECONDS", fit_time_budget_seconds), ("RUN_DEADLINE_SECONDS", run_deadline_seconds),
+                        ("RUN_MEMORY_BUDGET_MB", run_memory_budget_mb), ("PRICE_CACHE_MAX_AGE_SECONDS", price_cache_max_age)):
+        if value < 0:
+            errors.append(f"{name} 不可為負數: {value}")
+    return errors
+
+
+def check_config():
+    """--check-config：只檢查設定並列出啟用的模型與通知平台，不下載數據也不匯入模型套件"""
+    models = ["LSTM"] + (["Transformer"] if use_transformer else []) + (["Prophet"] if use_prophet else [])
+    sinks = [name for name, enabled in (
+        ("email", smtp_server and to_emails),
+        ("telegram", telegram_bot_token and telegram_channel_id),
+        ("discord", discord_webhook_url),
+        ("mongodb", mongo_uri),
+    ) if enabled]
+    print(f"模型: {', '.join(models)}{'（pooled）' if pooled_training else ''}"
+          f"{f'，Ensemble（{ensemble_method}）' if use_ensemble else ''}")
+    print(f"通知: {', '.join(sinks) or '無'}")
+    print(f"啟動耗時: {import_seconds:.3f}s")
+    errors = validate_config()
+    for error in errors:
+        print(f"⚠️ 設定錯誤: {error}")
+    if not errors:
+        print("設定檢查通過")
+    return 1 if errors else 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="每日潛力股分析")
+    parser.add_argument("--check-config", action="store_true", help="只檢查 .env 設定與啟動耗時，不執行分析")
+    return parser.parse_args(argv)
+
 
 # 主函數
 def main():
+    run_start = time.perf_counter()
+    errors = validate_config()
+    if errors:
+        for error in errors:
+            print(f"⚠️ 設定錯誤: {error}")
+        return 1
+    start_run_deadline()
+    history = None
     try:
         calculation_time = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
         period = "3mo"
         selected_indices = ["台灣50", "台灣中型100", "SP500"]
+        run_id = datetime.datetime.now().isoformat(timespec="seconds")
+
+        checkpoint = None
+        if run_checkpoint_file:
+            checkpoint = RunCheckpoint(run_checkpoint_file, {
+                "date": datetime.date.today().isoformat(),
+                "period": period,
+                "indices": selected_indices,
+                "use_transformer": use_transformer,
+                "transformer_period": transformer_period,
+                "use_prophet": use_prophet,
+                "pooled_training": pooled_training,
+                "ensemble": use_ensemble,
+            }, run_id)
+            run_id = checkpoint.run_id
+
+        if history_enabled():
+            history = PredictionHistory(run_id, datetime.date.today().isoformat(), plan_universe(selected_indices)[1],
+                                        history_batch_size)
+            # 上次中斷前可能還有未寫入的批次，重新寫入一次（相同的行會被覆蓋）
+            if checkpoint is not None:
+                for ticker, predictions in checkpoint.tickers.items():
+                    history.add_ticker(ticker, predictions)
 
         print("計算潛力股...")
-        analysis_results = get_top_and_bottom_10_potential_stocks(period, selected_indices)
-
-        # 分開處理每個指數的結果
-        for index_name, stock_predictions in analysis_results.items():
+        # 每個指數完成後立即發送，不必等待其他指數
+        published = []
+        for event in iter_index_results(period, selected_indices, checkpoint):
+            if history is not None and event[0] == "ticker":
+                history.add_ticker(event[1], event[2])
+            elif history is not None and event[0] == "index_model":
+                _, index_name, model, predictions = event
+                for prediction in predictions:
+                    history.add(index_name, model, prediction)
+            if event[0] != "index":
+                continue
+            _, index_name, stock_predictions = event
             print(f"處理並發送結果: {index_name}")
-            send_results(index_name, stock_predictions)
+            futures = send_results(index_name, stock_predictions)
+            published.append(index_name)
+            if checkpoint is not None:
+                # 發送是非同步的，所有平台都成功之後才標記為已發送，失敗的指數在續跑時會重新發送
+                when_delivered(futures, lambda name=index_name: checkpoint.mark_sent(name))
+
+        if checkpoint is not None:
+            flush_notifications()
+            unsent = [name for name in published if name not in checkpoint.sent]
+            if unsent:
+                print(f"⚠️ 以下指數未能送達所有平台，保留檢查點以便重新發送: {', '.join(unsent)}")
+            else:
+                checkpoint.remove()
 
     except Exception as e:
         print(f"錯誤: {str(e)}")
-        send_to_telegram(f"⚠️ 錯誤: {str(e)}")
+        if telegram_bot_token and telegram_channel_id:
+            _dispatch("telegram", send_to_telegram, f"⚠️ 錯誤: {str(e)}")
+    finally:
+        if history is not None:
+            history.flush()
+        flush_notifications()
+        if metrics_file:
+            metrics.write(metrics_file, run_seconds=round(time.perf_counter() - run_start, 3))
         
+
+# 模組本身的載入耗時（不含延遲匯入的模型套件，那些在第一次使用時各自記錄）
+import_seconds = time.perf_counter() - _import_start
+metrics.record("import", import_seconds, module="app")
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    args = parse_args()
+    sys.exit(check_config() if args.check_config else main())
\ No newline at end of file
@@ -0,0 +1,320 @@
+"""
+逐步向前 (walk-forward) 回測
+
+在歷史數據上逐日重現 app.py 的預測與排名：每個交易日以當時可取得的數據預測，
+依 app.TopBottomTracker 選出前十名 / 後十名並持有到下一個交易日，統計各模型的
+方向命中率、預測誤差，以及前十名 / 後十名的實際報酬。
+
+為了能在數百檔股票 x 5 年的規模下於數分鐘內完成：
+- 模型每 --retrain-every 個交易日才更新一次，期間以新增的交易日微調，每 --full-retrain-every 天才完整重新訓練
+- 兩次更新之間的所有交易日以一次 predict 批次預測
+- 每檔股票為一個工作單位，以 --workers 個進程並行運算
+
+預測方式與 app.py 相同：第 k 天的 LSTM / Transformer 預測值來自第 k - 60 到 k - 1 天的視窗，
+Prophet 預測第 k 天之後 3 天的價格；潛力 = 預測價 / 第 k 天收盤價 - 1，實際報酬為第 k 天到第 k + 1 天的收盤價變化。
+
+    python backtest.py --indices 道瓊 --period 5y --models lstm,prophet --workers 4
+    python backtest.py --synthetic 20 --period 2y --output backtest.jsonl
+    python backtest.py --synthetic 20 --period 2y --models lstm,prophet --ensemble rank
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+from concurrent.futures import as_completed
+
+# 回測不應讀寫正式的模型檢查點；子進程會繼承這些環境變數
+os.environ["MODEL_DIR"] = ""
+os.environ.setdefault("KERAS_VERBOSE", "0")
+
+import numpy as np
+import pandas as pd
+
+import app
+
+TIME_STEP = 60
+PROPHET_HORIZON_DAYS = 3  # 與 predict_with_prophet 的 prediction_days 相同
+
+
+def _fit_block(model_type, state, data, row, params):
+    """
+    返回第 row 天收盤後可用的模型狀態 (model, scaler, last_full_row, last_train_row)
+    距離上次完整訓練未滿 full_retrain_every 天時，沿用模型與 scaler，只以新增的交易日微調
+    """
+    if state is None or row - state[2] >= params["full_retrain_every"]:
+        train = data.iloc[row - params["train_days"] + 1:row + 1]
+        X_train, y_train, scaler = app.prepare_data(train, TIME_STEP)
+        return app.train_model(model_type, X_train, y_train), scaler, row, row
+
+    model, scaler, last_full_row, last_train_row = state
+    if params["finetune_epochs"] > 0 and row > last_train_row:
+        # 與 app 的檢查點微調相同：先以新增的交易日擴展 scaler 的 min / max，再只用新樣本微調
+        app.finetune_model(model, scaler, data.iloc[:row + 1], row - last_train_row, params["finetune_epochs"],
+                           model_type, TIME_STEP)
+    return model, scaler, last_full_row, row
+
+
+def _predict_block(model, scaler, data, start, end):
+    """一次預測第 start 到 end - 1 天，第 k 天使用第 k - TIME_STEP 到 k - 1 天的視窗"""
+    features = app.feature_frame(data.iloc[start - TIME_STEP - app.FEATURE_WARMUP_ROWS:end])
+    X = app.make_windows(scaler.transform(features)[app.FEATURE_WARMUP_ROWS:], TIME_STEP)[:-1]
+    predicted = np.asarray(model.predict(X, verbose=0)).reshape(len(X), -1)[:, -1]
+    return app.inverse_transform_close(scaler, predicted)
+
+
+def _predict_prophet_block(train, data, start, end):
+    model = app.train_prophet_model(train)
+    current = data['Close'].values[start:end]
+    future = pd.DataFrame({"ds": data.index[start:end] + pd.Timedelta(days=PROPHET_HORIZON_DAYS)})
+    yhat = model.predict(future)['yhat'].values
+    return np.clip(yhat, current * 0.8, current * 1.2)
+
+
+def backtest_ticker(ticker, data, models, params):
+    """
+    對單一股票逐步向前預測
+    :param params: train_days、retrain_every、full_retrain_every、finetune_epochs、start（第一個回測日期，可為 None）
+    :return: DataFrame，每個 (交易日, 模型) 一行：date、ticker、model、potential、current_price、predicted_price、next_return
+    """
+    data = data.dropna(subset=app.PRICE_COLUMNS)
+    closes = data['Close'].values.astype(np.float64)
+    first = max(params["train_days"] - 1, TIME_STEP + 1 + app.FEATURE_WARMUP_ROWS)
+    if params["start"] is not None:
+        first = max(first, int(data.index.searchsorted(pd.Timestamp(params["start"]))))
+    frames = []
+    for model_type in models:
+        state = None
+        for start in range(first, len(data) - 1, params["retrain_every"]):
+            end = min(start + params["retrain_every"], len(data) - 1)  # 最後一天沒有隔日報酬
+            try:
+                if model_type == "prophet":
+                    train = data.iloc[start - params["train_days"] + 1:start + 1]
+                    predicted = _predict_prophet_block(train, data, start, end)
+                else:
+                    state = _fit_block(model_type, state, data, start, params)
+                    predicted = _predict_block(state[0], state[1], data, start, end)
+            except Exception as e:
+                print(f"{model_type} 回測失敗: {ticker} {data.index[start].date()}, 錯誤: {str(e)}")
+                state = None
+                continue
+            current = closes[start:end]
+            frames.append(pd.DataFrame({
+                "date": data.index[start:end],
+                "ticker": ticker,
+                "model": model_type,
+                "potential": (predicted - current) / current,
+                "current_price": current,
+                "predicted_price": predicted,
+                "next_return": closes[start + 1:end + 1] / current - 1,
+            }))
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+
+def run_walk_forward(ticker_frames, models, params, workers=1):
+    """
+    並行回測所有股票
+    :param ticker_frames: {ticker: DataFrame}
+    :return: 所有股票的逐日預測 (DataFrame)
+    """
+    app.parallel_workers = workers
+    executor = app.create_executor()
+    results = []
+    if executor is None:
+        for ticker, data in ticker_frames.items():
+            results.append(backtest_ticker(ticker, data, models, params))
+            print(f"完成回測: {ticker}", file=sys.stderr)
+    else:
+        with executor:
+            futures = {executor.submit(backtest_ticker, ticker, data, models, params): ticker
+                       for ticker, data in ticker_frames.items()}
+            for future in as_completed(futures):
+                try:
+                    results.append(future.result())
+                    print(f"完成回測: {futures[future]}", file=sys.stderr)
+                except Exception as e:
+                    print(f"回測失敗: {futures[future]}, 錯誤: {str(e)}", file=sys.stderr)
+    results = [frame for frame in results if not frame.empty]
+    return pd.concat(results, ignore_index=True) if results else pd.DataFrame()
+
+
+def rank_daily(results, members, n=10):
+    """
+    以 app.TopBottomTracker 重現每個交易日的前 n 名與後 n 名
+    :param members: 指數成分股，決定潛力相同時的排序
+    :return: DataFrame，每個 (交易日, 模型) 一行：前 n 名、後 n 名與所有股票的平均隔日報酬
+    """
+    order = {ticker: i for i, ticker in enumerate(members)}
+    results = results[results["ticker"].isin(order)]
+    records = []
+    for (date, model), group in results.groupby(["date", "model"], sort=True):
+        tracker = app.TopBottomTracker(n)
+        for row in group.itertuples(index=False):
+            # Ensemble 依合併分數排名，其他模型的 score 為 NaN，依潛力排名
+            score = None if pd.isna(getattr(row, "score", np.nan)) else row.score
+            tracker.add((row.ticker, row.potential, row.next_return), order[row.ticker], score)
+        records.append({
+            "date": date,
+            "model": model,
+            "tickers": len(group),
+            "top_return": float(np.mean([p[2] for p in tracker.top()])),
+            "bottom_return": float(np.mean([p[2] for p in tracker.bottom()])),
+            "universe_return": float(group["next_return"].mean()),
+        })
+    return pd.DataFrame(records)
+
+
+def ensemble_rows(results, members, method="rank", weights=None):
+    """
+    以 app.ensemble_predictions 將同一交易日、同一指數內各模型的預測合併
+    :return: model 為 ensemble 的 DataFrame，欄位與 results 相同並多一欄排名用的 score
+    """
+    results = results[results["ticker"].isin(set(members))]
+    rows = []
+    for date, group in results.groupby("date", sort=True):
+        index_predictions, next_returns = {}, {}
+        for row in group.itertuples(index=False):
+            index_predictions.setdefault(row.ticker, {})[row.model] = (
+                row.ticker, row.potential, row.current_price, row.predicted_price)
+            next_returns[row.ticker] = row.next_return
+        for (ticker, potential, current_price, predicted_price), score in app.ensemble_predictions(
+                index_predictions, method, weights):
+            rows.append({"date": date, "ticker": ticker, "model": "ensemble", "potential": potential,
+                         "current_price": current_price, "predicted_price": predicted_price,
+                         "next_return": next_returns[ticker], "score": score})
+    return pd.DataFrame(rows)
+
+
+def summarize(results, daily):
+    """
+    彙總各模型的回測結果
+    hit_rate 為潛力與隔日報酬方向一致的比例，mape 為預測價相對隔日收盤價的平均絕對誤差，
+    *_return 為每日平均報酬，*_cumulative 為每日再平衡的累積報酬
+    """
+    summary = {}
+    for model, group in results.groupby("model"):
+        next_close = group["current_price"] * (1 + group["next_return"])
+        days = daily[daily["model"] == model]
+        summary[model] = {
+            "days": len(days),
+            "predictions": len(group),
+            "hit_rate": float((np.sign(group["potential"]) == np.sign(group["next_return"])).mean()),
+            "mape": float((np.abs(group["predicted_price"] - next_close) / next_close).mean()),
+            "top_return": float(days["top_return"].mean()),
+            "bottom_return": float(days["bottom_return"].mean()),
+            "universe_return": float(days["universe_return"].mean()),
+            "long_short_return": float((days["top_return"] - days["bottom_return"]).mean()),
+            "top_beats_universe": float((days["top_return"] > days["universe_return"]).mean()),
+            "top_cumulative": float(np.prod(1 + days["top_return"]) - 1),
+            "bottom_cumulative": float(np.prod(1 + days["bottom_return"]) - 1),
+            "universe_cumulative": float(np.prod(1 + days["universe_return"]) - 1),
+        }
+    return summary
+
+
+def print_summary(index_name, summary):
+    print(f"\n指數: {index_name}")
+    print(f"{'model':<12} {'days':>5} {'hit':>7} {'mape':>7} {'top':>8} {'bottom':>8} {'all':>8} "
+          f"{'top cum':>9} {'bot cum':>9} {'all cum':>9}")
+    for model, s in summary.items():
+        print(f"{model:<12} {s['days']:>5} {s['hit_rate']:>7.2%} {s['mape']:>7.2%} {s['top_return']:>8.3%} "
+              f"{s['bottom_return']:>8.3%} {s['universe_return']:>8.3%} {s['top_cumulative']:>9.2%} "
+              f"{s['bottom_cumulative']:>9.2%} {s['universe_cumulative']:>9.2%}")
+
+
+def load_universe(args):
+    """返回 ({index_name: 成分股}, {ticker: DataFrame})"""
+    if args.synthetic:
+        from bench import make_synthetic_ohlcv
+        rows = len(pd.bdate_range(app.period_start(args.period), pd.Timestamp.today().normalize()))
+        tickers = [f"SYN{i:03d}" for i in range(args.synthetic)]
+        return {"synthetic": tickers}, {
+            ticker: make_synthetic_ohlcv(rows, seed=args.seed + i) for i, ticker in enumerate(tickers)
+        }
+    if args.tickers:
+        members = {"custom": list(dict.fromkeys(args.tickers.split(",")))}
+        universe = members["custom"]
+    else:
+        universe, members = app.plan_universe(args.indices.split(","))
+    return members, app.get_index_stock_data(universe, args.period)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="逐步向前回測")
+    parser.add_argument("--indices", default="道瓊", help="要回測的指數，逗號分隔")
+    parser.add_argument("--tickers", help="直接指定股票代碼（逗號分隔），會取代 --indices")
+    parser.add_argument("--synthetic", type=int, default=0, help="改用 N 檔合成數據，不需要網路")
+    parser.add_argument("--period", default="5y", help="下載的歷史數據區間，前 --train-days 天只用於訓練")
+    parser.add_argument("--start", help="第一個回測日期 (YYYY-MM-DD)，默認為數據足夠訓練的第一天")
+    parser.add_argument("--models", default="lstm", help="要回測的模型：lstm、transformer、prophet")
+    parser.add_argument("--ensemble", choices=("rank", "weighted"),
+                        help="額外回測各模型合併後的 Ensemble 排名，權重取自 ENSEMBLE_WEIGHTS")
+    parser.add_argument("--train-days", type=int, default=252, help="每次完整訓練使用的交易日數")
+    parser.add_argument("--retrain-every", type=int, default=21, help="每隔多少個交易日更新一次模型")
+    parser.add_argument("--full-retrain-every", type=int, default=252, help="每隔多少個交易日完整重新訓練")
+    parser.add_argument("--finetune-epochs", type=int, default=app.finetune_epochs, help="兩次完整訓練之間的微調 epoch 數")
+    parser.add_argument("--workers", type=int, default=app.parallel_workers)
+    parser.add_argument("--top", type=int, default=10, help="前 / 後幾名")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="將每個指數的彙總以 JSON lines 追加到此檔案")
+    parser.add_argument("--daily", help="將每日的排名報酬寫入此 CSV 檔案")
+    args = parser.parse_args()
+
+    if args.train_days <= TIME_STEP + 1:
+        parser.error(f"--train-days 必須大於 {TIME_STEP + 1}")
+    models = [model for model in args.models.split(",") if model]
+    unknown = set(models) - {"lstm", "transformer", "prophet"}
+    if unknown:
+        parser.error(f"未知的模型: {', '.join(sorted(unknown))}")
+
+    import keras
+    keras.utils.set_random_seed(args.seed)
+
+    start_time = time.perf_counter()
+    members, ticker_frames = load_universe(args)
+    params = {
+        "train_days": args.train_days,
+        "retrain_every": args.retrain_every,
+        "full_retrain_every": args.full_retrain_every,
+        "finetune_epochs": args.finetune_epochs,
+        "start": args.start,
+    }
+    ticker_frames = {ticker: data for ticker, data in ticker_frames.items() if len(data) > args.train_days + 1}
+    print(f"回測 {len(ticker_frames)} 檔股票，模型: {', '.join(models)}", file=sys.stderr)
+    results = run_walk_forward(ticker_frames, models, params, args.workers)
+    if results.empty:
+        print("沒有可回測的數據")
+        return
+
+    daily_frames = []
+    for index_name, stock_list in members.items():
+        index_results = results[results["ticker"].isin(stock_list)]
+        if args.ensemble:
+            index_results = pd.concat(
+                [index_results, ensemble_rows(index_results, stock_list, args.ensemble, app.ensemble_weights)],
+                ignore_index=True)
+        daily = rank_daily(index_results, stock_list, args.top)
+        if daily.empty:
+            continue
+        summary = summarize(index_results, daily)
+        print_summary(index_name, summary)
+        daily_frames.append(daily.assign(index_name=index_name))
+        if args.output:
+            with open(args.output, "a", encoding="utf-8") as f:
+                f.write(json.dumps({
+                    "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+                    "index": index_name,
+                    "period": args.period,
+                    **params,
+                    "ensemble": args.ensemble,
+                    "seconds": round(time.perf_counter() - start_time, 1),
+                    "models": summary,
+                }, ensure_ascii=False) + "\n")
+    if args.daily and daily_frames:
+        pd.concat(daily_frames, ignore_index=True).to_csv(args.daily, index=False)
+    print(f"\n回測完成，耗時 {time.perf_counter() - start_time:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
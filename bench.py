@@ -0,0 +1,223 @@
+"""
+訓練 / 預測熱路徑的基準測試
+
+以固定亂數種子產生合成 OHLCV 數據，不需要網路，分別計時每個階段並輸出 JSON lines，
+方便比較不同 commit 之間的效能。
+
+    python bench.py --lengths 3mo,1y,5y --tickers 1,5 --output bench_results.jsonl
+    python bench.py --compare old.jsonl new.jsonl
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import datetime
+import contextlib
+import threading
+from collections import defaultdict
+
+# 基準測試不應讀寫模型檢查點，也不輸出 Keras 進度條
+os.environ["MODEL_DIR"] = ""
+os.environ.setdefault("KERAS_VERBOSE", "0")
+
+import numpy as np
+import pandas as pd
+
+import app
+
+# 各區間對應的交易日數
+LENGTHS = {"3mo": 63, "6mo": 126, "1y": 252, "2y": 504, "5y": 1260}
+
+# 階段執行期間取樣目前 RSS 的間隔（秒）
+RSS_SAMPLE_SECONDS = 0.01
+
+
+def make_synthetic_ohlcv(rows, seed=0, end="2024-12-31"):
+    """
+    產生固定種子的合成 OHLCV 數據（幾何布朗運動）
+    :param rows: 交易日數
+    :param seed: 亂數種子，相同種子產生相同數據
+    :return: 與 yf.download 相同欄位、索引名稱為 Date 的 DataFrame
+    """
+    rng = np.random.default_rng(seed)
+    close = 100 * np.exp(np.cumsum(rng.normal(0.0003, 0.015, rows)))
+    open_ = close * (1 + rng.normal(0, 0.003, rows))
+    high = np.maximum(open_, close) * (1 + np.abs(rng.normal(0, 0.005, rows)))
+    low = np.minimum(open_, close) * (1 - np.abs(rng.normal(0, 0.005, rows)))
+    volume = rng.integers(1_000_000, 10_000_000, rows).astype(float)
+    index = pd.bdate_range(end=end, periods=rows, name="Date")
+    return pd.DataFrame({"Open": open_, "High": high, "Low": low, "Close": close, "Volume": volume}, index=index)
+
+
+class StageTimer:
+    """
+    記錄每個階段的耗時與記憶體
+    ru_maxrss 是整個進程的最高水位，之後的階段除非超過先前的峰值否則增量都是 0，
+    因此改為在階段執行期間以背景執行緒取樣目前 RSS，記錄階段內的峰值增量與結束時仍保留的增量
+    """
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+
+    def run(self, stage, func, *args, **kwargs):
+        rss_before = app.current_rss_mb()
+        peak = [rss_before]
+        done = threading.Event()
+
+        def sample():
+            while not done.wait(RSS_SAMPLE_SECONDS):
+                peak[0] = max(peak[0], app.current_rss_mb())
+
+        sampler = threading.Thread(target=sample, daemon=True) if rss_before is not None else None
+        if sampler is not None:
+            sampler.start()
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            done.set()
+            if sampler is not None:
+                sampler.join()
+        if rss_before is None:
+            # 沒有 /proc 的平台無法取得目前 RSS，只記錄耗時
+            self.samples[stage].append((elapsed, None, None))
+        else:
+            rss_after = app.current_rss_mb()
+            self.samples[stage].append((elapsed, max(peak[0], rss_after) - rss_before, rss_after - rss_before))
+        return result
+
+
+def bench_ticker(timer, data, models, epochs, quantization="none"):
+    X_train, y_train, scaler = timer.run("prepare_data", app.prepare_data, data)
+    input_shape = (X_train.shape[1], X_train.shape[2])
+
+    if "lstm" in models:
+        model = timer.run("lstm_build_compile", app.build_lstm_model, input_shape)
+        timer.run("lstm_fit", model.fit, X_train, y_train, epochs=epochs, batch_size=32, verbose=0)
+        timer.run("lstm_predict_full", app.predict_stock, model, data, scaler)
+        timer.run("lstm_predict_last", app.predict_stock, model, data, scaler, last_only=True)
+        lite_model = app.LiteModel(timer.run("lstm_tflite_export", app.export_lite_model, model, quantization))
+        timer.run("lstm_tflite_predict_last", app.predict_stock, lite_model, data, scaler, last_only=True)
+
+    if "transformer" in models:
+        model = timer.run("transformer_build_compile", app.build_transformer_model, input_shape)
+        timer.run("transformer_fit", model.fit, X_train, y_train, epochs=epochs, batch_size=32, verbose=0)
+        timer.run("transformer_predict_full", app.predict_transformer, model, data, scaler)
+        timer.run("transformer_predict_last", app.predict_transformer, model, data, scaler, last_only=True)
+        lite_model = app.LiteModel(timer.run("transformer_tflite_export", app.export_lite_model, model, quantization))
+        timer.run("transformer_tflite_predict_last", app.predict_transformer, lite_model, data, scaler, last_only=True)
+
+    if "prophet" in models:
+        model = timer.run("prophet_fit", app.train_prophet_model, data)
+        timer.run("prophet_predict", app.predict_with_prophet, model, data)
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       stderr=subprocess.DEVNULL, cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(lengths, ticker_counts, models, epochs, seed, quantization="none"):
+    import keras
+    import tensorflow as tf
+
+    environment = {
+        "commit": _git_commit(),
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "tensorflow": tf.__version__,
+        "keras": keras.__version__,
+        "cpu_count": os.cpu_count(),
+        "epochs": epochs,
+        "seed": seed,
+        "tflite_quantization": quantization,
+    }
+    results = []
+    for length in lengths:
+        for ticker_count in ticker_counts:
+            keras.utils.set_random_seed(seed)
+            timer = StageTimer()
+            start = time.perf_counter()
+            for i in range(ticker_count):
+                bench_ticker(timer, make_synthetic_ohlcv(LENGTHS[length], seed=seed + i), models, epochs, quantization)
+            total = time.perf_counter() - start
+
+            for stage, samples in timer.samples.items():
+                wall = [elapsed for elapsed, _, _ in samples]
+                peak_deltas = [delta for _, delta, _ in samples if delta is not None]
+                retained_deltas = [delta for _, _, delta in samples if delta is not None]
+                results.append({
+                    **environment,
+                    "length": length,
+                    "rows": LENGTHS[length],
+                    "tickers": ticker_count,
+                    "stage": stage,
+                    "wall_s_total": round(sum(wall), 6),
+                    "wall_s_per_ticker": round(sum(wall) / len(wall), 6),
+                    "wall_s_max": round(max(wall), 6),
+                    "peak_rss_delta_mb": round(max(peak_deltas), 2) if peak_deltas else None,
+                    "rss_delta_mb": round(max(retained_deltas), 2) if retained_deltas else None,
+                })
+            results.append({**environment, "length": length, "rows": LENGTHS[length], "tickers": ticker_count,
+                            "stage": "total", "wall_s_total": round(total, 6),
+                            "wall_s_per_ticker": round(total / ticker_count, 6), "peak_rss_mb": app.peak_rss_mb(), "rss_mb": app.current_rss_mb()})
+            print(f"完成 {length} x {ticker_count} 檔: {total:.2f}s", file=sys.stderr)
+    return results
+
+
+def compare(baseline_path, candidate_path):
+    """比較兩次基準測試每個階段的平均耗時"""
+    def load(path):
+        with open(path, encoding="utf-8") as f:
+            return {(r["length"], r["tickers"], r["stage"]): r["wall_s_per_ticker"] for r in map(json.loads, f) if r}
+
+    baseline, candidate = load(baseline_path), load(candidate_path)
+    print(f"{'length':>6} {'tickers':>7} {'stage':<28} {'baseline':>10} {'candidate':>10} {'ratio':>7}")
+    for key in sorted(baseline.keys() & candidate.keys()):
+        ratio = candidate[key] / baseline[key] if baseline[key] else float("nan")
+        print(f"{key[0]:>6} {key[1]:>7} {key[2]:<28} {baseline[key]:>10.4f} {candidate[key]:>10.4f} {ratio:>7.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="訓練 / 預測熱路徑基準測試")
+    parser.add_argument("--lengths", default="3mo,1y,5y", help=f"數據長度，可選 {','.join(LENGTHS)}")
+    parser.add_argument("--tickers", default="1,5", help="股票數量，逗號分隔")
+    parser.add_argument("--models", default="lstm,transformer,prophet", help="要測試的模型")
+    parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--quantization", default="none", choices=app.TFLITE_QUANTIZATIONS, help="TFLite 量化方式")
+    parser.add_argument("--output", help="將結果以 JSON lines 追加到此檔案，未指定時輸出到 stdout")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CANDIDATE"), help="比較兩個結果檔案")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    # 各階段的輸出（例如 predict_transformer 的 print）導向 stderr，stdout 只保留 JSON lines
+    with contextlib.redirect_stdout(sys.stderr):
+        results = run_benchmarks(
+            [length for length in args.lengths.split(",") if length],
+            [int(count) for count in args.tickers.split(",") if count],
+            set(args.models.split(",")),
+            args.epochs,
+            args.seed,
+            args.quantization,
+        )
+    lines = "".join(json.dumps(result, ensure_ascii=False) + "\n" for result in results)
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as f:
+            f.write(lines)
+    else:
+        sys.stdout.write(lines)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,332 @@
+"""
+盤中 (intraday) 滾動視窗模式
+
+以分鐘線（例如 5 分鐘）持續更新 LSTM / Transformer 的預測：每檔股票只保留固定長度的環形緩衝區，
+新的 K 線逐筆追加，每次刷新只重新評分緩衝區有變化的股票，並只對最後一個視窗做一次前向計算，
+因此刷新延遲不會隨累積的歷史變長，記憶體也固定為 股票數 x --capacity 根 K 線。
+
+模型在緩衝區第一次累積到 --min-bars 根 K 線時以整個緩衝區訓練，之後每新增 --retrain-every 根 K 線
+以新增的 K 線微調（與 app.py 的檢查點微調相同）。Prophet 以日線季節性建模，不適用於盤中模式。
+
+數據來源可替換：默認從 Yahoo Finance 下載，--replay 改為逐步重播本地 CSV（Datetime,Ticker,Open,High,Low,Close,Volume），
+方便在沒有網路時測試；--record 可將下載到的 K 線以相同格式保存，之後重播。
+
+    python intraday.py --tickers AAPL,MSFT,NVDA --interval 5m --refresh 300
+    python intraday.py --indices 道瓊 --interval 5m --record bars.csv
+    python intraday.py --replay bars.csv --step 1 --output intraday.jsonl
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+
+# 盤中模型只保存在記憶體中，不應覆蓋日線的模型檢查點
+os.environ["MODEL_DIR"] = ""
+os.environ.setdefault("KERAS_VERBOSE", "0")
+
+import numpy as np
+import pandas as pd
+
+import app
+
+TIME_STEP = 60
+REPLAY_COLUMNS = ["Datetime", "Ticker"] + app.PRICE_COLUMNS
+
+
+class RingBuffer:
+    """
+    固定容量的 K 線緩衝區，容量已滿時新的 K 線覆蓋最舊的 K 線
+    時間與 OHLCV 以預先配置的 numpy 陣列保存，追加時不會重新配置或複製歷史數據
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._times = np.empty(capacity, dtype="datetime64[ns]")
+        self._values = np.empty((capacity, len(app.PRICE_COLUMNS)), dtype=np.float64)
+        self._end = 0  # 下一根 K 線寫入的位置
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def last_time(self):
+        return self._times[(self._end - 1) % self.capacity] if self.size else None
+
+    def append(self, bars):
+        """
+        追加比最後一根更新的 K 線；與最後一根時間相同的 K 線（尚未收盤的 K 線）會覆蓋最後一根
+        :param bars: 以時間為索引、包含 PRICE_COLUMNS 的 DataFrame
+        :return: (新增的 K 線數, 最後一根是否被更新)
+        """
+        bars = bars.dropna(subset=app.PRICE_COLUMNS)
+        times = bars.index.values.astype("datetime64[ns]")
+        values = bars[app.PRICE_COLUMNS].values.astype(np.float64)
+        replaced = False
+        last_time = self.last_time
+        if last_time is not None:
+            same = times == last_time
+            if same.any():
+                last = (self._end - 1) % self.capacity
+                replaced = not np.array_equal(self._values[last], values[same][-1])
+                self._values[last] = values[same][-1]
+            newer = times > last_time
+            times, values = times[newer], values[newer]
+        # 超過容量的部分只保留最後 capacity 根
+        times, values = times[-self.capacity:], values[-self.capacity:]
+        positions = (self._end + np.arange(len(times))) % self.capacity
+        self._times[positions] = times
+        self._values[positions] = values
+        self._end = (self._end + len(times)) % self.capacity
+        self.size = min(self.size + len(times), self.capacity)
+        return len(times), replaced
+
+    def tail(self, n=None):
+        """返回最後 n 根 K 線（默認全部），按時間排序的 DataFrame"""
+        n = self.size if n is None else min(n, self.size)
+        positions = (self._end - n + np.arange(n)) % self.capacity
+        return pd.DataFrame(self._values[positions], columns=app.PRICE_COLUMNS,
+                            index=pd.DatetimeIndex(self._times[positions], name="Datetime"))
+
+
+# 數據來源：fetch(tickers) 返回 {ticker: DataFrame}，可以包含已經收到的 K 線，由 RingBuffer 去重
+class BarSource:
+    realtime = False  # 即時來源在兩次刷新之間等待 --refresh 秒，重播來源不等待
+    exhausted = False
+
+    def fetch(self, tickers):
+        raise NotImplementedError
+
+
+class YahooBarSource(BarSource):
+    """從 Yahoo Finance 下載分鐘線，第一次下載 history 的歷史，之後只下載最近一天"""
+    realtime = True
+
+    def __init__(self, interval="5m", history="1mo", refresh_period="1d"):
+        self.interval = interval
+        self.history = history
+        self.refresh_period = refresh_period
+        self._started = False
+
+    def fetch(self, tickers):
+        period = self.refresh_period if self._started else self.history
+        self._started = True
+        return app._bulk_download(list(tickers), period=period, interval=self.interval)
+
+
+class ReplayBarSource(BarSource):
+    """
+    逐步重播本地 CSV：第一次返回前 warmup 個時間點，之後每次返回接下來 step 個時間點的 K 線
+    """
+
+    def __init__(self, path, step=1, warmup=0):
+        bars = pd.read_csv(path, parse_dates=["Datetime"])
+        self._times = np.sort(bars["Datetime"].unique())
+        self._frames = {ticker: frame.set_index("Datetime")[app.PRICE_COLUMNS].sort_index()
+                        for ticker, frame in bars.groupby("Ticker")}
+        self.tickers = list(self._frames)
+        self.step = step
+        self.warmup = warmup
+        self._position = 0
+
+    def fetch(self, tickers):
+        if self._position >= len(self._times):
+            self.exhausted = True
+            return {}
+        start = self._times[self._position]
+        self._position += self.warmup if self._position == 0 and self.warmup else self.step
+        end = self._times[min(self._position, len(self._times)) - 1]
+        self.exhausted = self._position >= len(self._times)
+        return {ticker: frame.loc[start:end] for ticker, frame in self._frames.items()
+                if ticker in tickers and not frame.loc[start:end].empty}
+
+
+def record_bars(path, bars):
+    """將 K 線以重播格式追加到 CSV"""
+    frames = [frame[app.PRICE_COLUMNS].rename_axis("Datetime").reset_index().assign(Ticker=ticker)
+              for ticker, frame in bars.items() if not frame.empty]
+    if frames:
+        pd.concat(frames)[REPLAY_COLUMNS].to_csv(path, mode="a", index=False, header=not os.path.exists(path))
+
+
+class IntradayScorer:
+    """
+    保存每檔股票的環形緩衝區與記憶體中的模型，只重新評分緩衝區有變化的股票
+    """
+
+    def __init__(self, models=("lstm",), capacity=2000, min_bars=2 * TIME_STEP, retrain_every=0, finetune_epochs=1):
+        if min_bars <= TIME_STEP + 1 + app.FEATURE_WARMUP_ROWS:
+            raise ValueError(f"min_bars 必須大於 {TIME_STEP + 1 + app.FEATURE_WARMUP_ROWS}")
+        self.models = models
+        self.capacity = capacity
+        self.min_bars = min_bars
+        self.retrain_every = retrain_every
+        self.finetune_epochs = finetune_epochs
+        self.buffers = {}
+        self.states = {}  # {(ticker, model): [model, scaler, 上次訓練後新增的 K 線數]}
+
+    def update(self, bars):
+        """
+        將新的 K 線加入緩衝區
+        :param bars: {ticker: DataFrame}
+        :return: 緩衝區有變化的股票
+        """
+        changed = []
+        for ticker, frame in bars.items():
+            buffer = self.buffers.setdefault(ticker, RingBuffer(self.capacity))
+            new_rows, replaced = buffer.append(frame)
+            if new_rows or replaced:
+                changed.append(ticker)
+            for model_type in self.models:
+                state = self.states.get((ticker, model_type))
+                if state is not None:
+                    state[2] += new_rows
+        return changed
+
+    def _fit(self, ticker, model_type):
+        """第一次以整個緩衝區訓練，之後新增的 K 線達到 retrain_every 時只以新增的 K 線微調"""
+        buffer = self.buffers[ticker]
+        state = self.states.get((ticker, model_type))
+        if state is None:
+            X_train, y_train, scaler = app.prepare_data(buffer.tail(), TIME_STEP)
+            model = app.train_model(model_type, X_train, y_train)
+            state = self.states[(ticker, model_type)] = [model, scaler, 0]
+        elif self.retrain_every and self.finetune_epochs > 0 and state[2] >= self.retrain_every:
+            model, scaler, new_rows = state
+            new_rows = min(new_rows, len(buffer) - TIME_STEP - app.FEATURE_WARMUP_ROWS)
+            recent = buffer.tail(new_rows + TIME_STEP + app.FEATURE_WARMUP_ROWS)
+            app.finetune_model(model, scaler, recent, new_rows, self.finetune_epochs, model_type, TIME_STEP)
+            state[2] = 0
+        return state[0], state[1]
+
+    def score(self, tickers):
+        """
+        只用最後一個視窗預測下一根 K 線的收盤價
+        :return: {ticker: {模型名稱: (ticker, potential, current_price, predicted_price)}}
+        """
+        results = {}
+        for ticker in tickers:
+            buffer = self.buffers.get(ticker)
+            if buffer is None or len(buffer) < self.min_bars:
+                app.metrics.incr("tickers_skipped", reason="warmup")
+                continue
+            recent = buffer.tail(TIME_STEP + 1 + app.FEATURE_WARMUP_ROWS)
+            current_price = float(recent['Close'].values[-1])
+            for model_type in self.models:
+                try:
+                    with app.metrics.span("model", model=model_type, ticker=ticker):
+                        model, scaler = self._fit(ticker, model_type)
+                        predict = app.predict_stock if model_type == "lstm" else app.predict_transformer
+                        predicted_price = float(predict(model, recent, scaler, TIME_STEP, last_only=True)[-1])
+                except Exception as e:
+                    app.metrics.incr("tickers_failed", model=model_type)
+                    print(f"{model_type} 盤中預測失敗: {ticker}, 錯誤: {str(e)}")
+                    continue
+                potential = (predicted_price - current_price) / current_price
+                results.setdefault(ticker, {})[model_type] = (ticker, potential, current_price, predicted_price)
+        return results
+
+
+def rank(latest, tickers, models, n=10):
+    """以 app.TopBottomTracker 對最新的預測排名，返回與 app.build_stock_predictions 相同格式的結果"""
+    order = {ticker: i for i, ticker in enumerate(tickers)}
+    trackers = {model: app.TopBottomTracker(n) for model in models}
+    for ticker, predictions in latest.items():
+        for model, prediction in predictions.items():
+            trackers[model].add(prediction, order.get(ticker, len(order)))
+    return app.build_stock_predictions(trackers)
+
+
+def run(source, scorer, tickers, refresh_seconds=300, top=10, max_refreshes=0, output=None, record=None):
+    """
+    刷新迴圈：下載新的 K 線 → 更新緩衝區 → 重新評分有變化的股票 → 輸出排名
+    :param max_refreshes: 刷新次數上限，0 表示直到數據來源結束
+    """
+    latest = {}
+    refreshes = 0
+    while not source.exhausted and (not max_refreshes or refreshes < max_refreshes):
+        started = time.perf_counter()
+        with app.metrics.span("refresh") as stats:
+            bars = source.fetch(tickers)
+            if record:
+                record_bars(record, bars)
+            changed = scorer.update(bars)
+            for ticker, predictions in scorer.score(changed).items():
+                latest.setdefault(ticker, {}).update(predictions)
+            stats.update(changed=len(changed), scored=len(latest))
+        refreshes += 1
+        elapsed = time.perf_counter() - started
+        last_bar = max((buffer.last_time for buffer in scorer.buffers.values()), default=None)
+        print(f"\n刷新 {refreshes}: 最新 K 線 {pd.Timestamp(last_bar) if last_bar is not None else '-'}，"
+              f"{len(changed)} 檔有變化，耗時 {elapsed:.2f}s")
+        stock_predictions = rank(latest, tickers, scorer.models, top)
+        for section, predictions in stock_predictions.items():
+            print(section)
+            for ticker, potential, current_price, predicted_price in predictions:
+                print(f"  {ticker}: 潛力 {potential:.2%}，現價 {current_price:.2f}，預測價 {predicted_price:.2f}")
+        if output:
+            with open(output, "a", encoding="utf-8") as f:
+                f.write(json.dumps({
+                    "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+                    "bar": str(pd.Timestamp(last_bar)) if last_bar is not None else None,
+                    "changed": changed,
+                    "seconds": round(elapsed, 3),
+                    "predictions": stock_predictions,
+                }, ensure_ascii=False) + "\n")
+        # 長時間執行時每次刷新都寫出並清空指標，記憶體不隨刷新次數增長
+        if app.metrics_file:
+            app.metrics.write(app.metrics_file, refresh=refreshes, changed=len(changed))
+        app.metrics.drain()
+        if source.realtime and not source.exhausted:
+            time.sleep(max(0.0, refresh_seconds - elapsed))
+    return latest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="盤中滾動視窗預測")
+    parser.add_argument("--indices", default="道瓊", help="要監看的指數，逗號分隔")
+    parser.add_argument("--tickers", help="直接指定股票代碼（逗號分隔），會取代 --indices")
+    parser.add_argument("--replay", help="重播本地 CSV 而不是下載，欄位為 " + ",".join(REPLAY_COLUMNS))
+    parser.add_argument("--step", type=int, default=1, help="重播時每次刷新前進的 K 線數")
+    parser.add_argument("--record", help="將下載到的 K 線追加到此 CSV，可供 --replay 使用")
+    parser.add_argument("--interval", default="5m", help="K 線週期 (yfinance interval)")
+    parser.add_argument("--history", default="1mo", help="啟動時下載的歷史區間")
+    parser.add_argument("--refresh", type=float, default=300, help="兩次刷新之間的秒數")
+    parser.add_argument("--max-refreshes", type=int, default=0, help="刷新次數上限，0 表示不限制")
+    parser.add_argument("--models", default="lstm", help="要使用的模型：lstm、transformer")
+    parser.add_argument("--capacity", type=int, default=2000, help="每檔股票保留的 K 線數")
+    parser.add_argument("--min-bars", type=int, default=2 * TIME_STEP, help="開始訓練所需的 K 線數")
+    parser.add_argument("--retrain-every", type=int, default=12, help="每新增幾根 K 線微調一次，0 表示不微調")
+    parser.add_argument("--finetune-epochs", type=int, default=1)
+    parser.add_argument("--top", type=int, default=10, help="前 / 後幾名")
+    parser.add_argument("--output", help="將每次刷新的排名以 JSON lines 追加到此檔案")
+    args = parser.parse_args()
+
+    models = tuple(model for model in args.models.split(",") if model)
+    unknown = set(models) - {"lstm", "transformer"}
+    if unknown:
+        parser.error(f"盤中模式不支援的模型: {', '.join(sorted(unknown))}")
+    if args.capacity < args.min_bars:
+        parser.error("--capacity 不能小於 --min-bars")
+    if args.min_bars <= TIME_STEP + 1 + app.FEATURE_WARMUP_ROWS:
+        parser.error(f"--min-bars 必須大於 {TIME_STEP + 1 + app.FEATURE_WARMUP_ROWS}")
+
+    if args.replay:
+        source = ReplayBarSource(args.replay, args.step, warmup=args.min_bars)
+        tickers = [ticker for ticker in args.tickers.split(",") if ticker] if args.tickers else source.tickers
+    else:
+        source = YahooBarSource(args.interval, args.history)
+        tickers = (list(dict.fromkeys(args.tickers.split(","))) if args.tickers
+                   else app.plan_universe(args.indices.split(","))[0])
+    scorer = IntradayScorer(models, args.capacity, args.min_bars, args.retrain_every, args.finetune_epochs)
+    print(f"監看 {len(tickers)} 檔股票，模型: {', '.join(models)}", file=sys.stderr)
+    try:
+        run(source, scorer, tickers, args.refresh, args.top, args.max_refreshes, args.output, args.record)
+    except KeyboardInterrupt:
+        print("已停止")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+"""
+常駐的預測服務
+
+在單一進程中保留已訓練的模型與 scaler，以 HTTP 回答單一股票或整個指數的潛力查詢，不必每次執行完整的 main()。
+- 模型快取以 LRU 淘汰，最多保留 --cache-size 個模型；未命中時才從 MODEL_DIR 的檢查點（或 TFLite 檔）載入，
+  沒有可用的檢查點時才訓練，與批次執行共用同一套檢查點
+- 價格數據在 --data-ttl 秒內沿用，數據沒有新的 K 線時直接返回快取的預測
+- 同一檔股票、同一模型的並發請求只計算一次，其他請求等待同一個結果
+
+    python service.py --port 8000 --preload 道瓊
+    curl 'http://127.0.0.1:8000/predict?ticker=AAPL&models=lstm,prophet'
+    curl 'http://127.0.0.1:8000/index?name=道瓊&models=lstm&top=10'
+    curl 'http://127.0.0.1:8000/stats'
+"""
+import sys
+import json
+import time
+import argparse
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import app
+
+MODELS = ("lstm", "transformer", "prophet")
+MEMBERS_TTL_SECONDS = 24 * 3600  # 指數成分股很少變動
+METRICS_FLUSH_SPANS = 10000  # 累積的 span 超過此數量時寫出並清空，常駐時記憶體不隨請求數增長
+
+
+class LRUCache:
+    """執行緒安全的 LRU 快取，超過 max_items 時淘汰最久未使用的項目"""
+
+    def __init__(self, max_items):
+        self.max_items = max_items
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        return {"size": len(self._items), "max_items": self.max_items, "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions}
+
+
+class SingleFlight:
+    """相同 key 的並發呼叫只執行一次，其他呼叫等待並取得同一個結果（或例外）"""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def do(self, key, func):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+            else:
+                self.coalesced += 1
+        if not leader:
+            return future.result()
+        try:
+            future.set_result(func())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._calls[key]
+        return future.result()
+
+
+class ScoringService:
+    """
+    以 LRU 快取保存模型、價格數據與預測結果，查詢時只計算快取中沒有的部分
+    :param period: LSTM / Prophet 使用的數據區間，Transformer 使用 TRANSFORMER_PERIOD
+    """
+
+    def __init__(self, period="3mo", cache_size=500, data_ttl=300, model_ttl=3600):
+        self.period = period
+        self.data_period = app.longest_period([period, app.transformer_period] if app.use_transformer else [period])
+        self.data_ttl = data_ttl
+        self.model_ttl = model_ttl
+        self.models = LRUCache(cache_size)           # (model_type, ticker) -> (loaded_at, model, scaler)
+        self.data = LRUCache(cache_size * 10)        # ticker -> (fetched_at, DataFrame)
+        self.results = LRUCache(cache_size * 10)     # (model_type, ticker) -> (最後一根 K 線, prediction)
+        self.members = {}                            # index_name -> (fetched_at, 成分股)
+        self.flights = SingleFlight()
+
+    def enabled_models(self, models=None):
+        enabled = {"lstm": True, "transformer": app.use_transformer, "prophet": app.use_prophet}
+        return [model for model in (models or MODELS) if enabled.get(model)]
+
+    # 價格數據
+    def _store_data(self, frames):
+        now = time.time()
+        for ticker, data in frames.items():
+            self.data.put(ticker, (now, data))
+
+    def get_data(self, ticker):
+        cached = self.data.get(ticker)
+        if cached is not None and time.time() - cached[0] < self.data_ttl:
+            return cached[1]
+
+        def fetch():
+            data = app.get_index_stock_data([ticker], self.data_period, self.data_ttl).get(ticker)
+            if data is None or data.empty:
+                raise LookupError(f"找不到 {ticker} 的價格數據")
+            self._store_data({ticker: data})
+            return data
+
+        return self.flights.do(("data", ticker), fetch)
+
+    def prefetch(self, tickers):
+        """以單次請求下載多檔股票中已過期的數據"""
+        now = time.time()
+        stale = []
+        for ticker in tickers:
+            cached = self.data.get(ticker)
+            if cached is None or now - cached[0] >= self.data_ttl:
+                stale.append(ticker)
+        if stale:
+            self._store_data(app.get_index_stock_data(stale, self.data_period, self.data_ttl))
+
+    # 模型
+    def get_model(self, model_type, ticker, data):
+        """
+        返回 (model, scaler)；快取未命中時經 fit_ticker_model 從檢查點載入（數據有新交易日時微調，沒有檢查點時訓練）
+        Prophet 的 scaler 為 None，由 train_prophet_model 的 Prophet 快取決定是否重新擬合
+        """
+        cached = self.models.get((model_type, ticker))
+        if cached is not None and time.time() - cached[0] < self.model_ttl:
+            return cached[1], cached[2]
+
+        def load():
+            with app.metrics.span("load_model", model=model_type, ticker=ticker):
+                if model_type == "prophet":
+                    model, scaler = app.train_prophet_model(data, ticker), None
+                else:
+                    model, scaler = app.fit_ticker_model(model_type, ticker, data)
+                    model = app.to_inference_model(model_type, ticker, model)
+            self.models.put((model_type, ticker), (time.time(), model, scaler))
+            return model, scaler
+
+        return self.flights.do(("model", model_type, ticker), load)
+
+    # 預測
+    def _predict(self, model_type, ticker):
+        data = self.get_data(ticker)
+        if model_type == "transformer":
+            data = app.slice_period(data, app.transformer_period)
+        else:
+            data = app.slice_period(data, self.period)
+        if model_type != "prophet" and len(data) < 60:
+            raise ValueError(f"{ticker} 的數據不足 60 天")
+        last_bar = (data.index[-1], float(data['Close'].values[-1]))
+        cached = self.results.get((model_type, ticker))
+        if cached is not None and cached[0] == last_bar:
+            return cached[1]
+
+        model, scaler = self.get_model(model_type, ticker, data)
+        current_price = float(data['Close'].values[-1])
+        with app.metrics.span("score", model=model_type):
+            if model_type == "prophet":
+                predicted_price = float(app.predict_with_prophet(model, data)['yhat'].iloc[-1])
+            elif model_type == "lstm":
+                predicted_price = float(app.predict_stock(model, data, scaler, last_only=True)[-1])
+            else:
+                predicted_price = float(app.predict_transformer(model, data, scaler, last_only=True)[-1])
+        if app.inference_backend == "tflite" and model_type != "prophet" and not isinstance(model, app.LiteModel):
+            # 模型會留在快取中重複預測，值得轉換；以剛算出的 Keras 預測檢驗轉換結果
+            lite_model = app.export_inference_model(model_type, ticker, model, data, scaler, predicted_price)
+            if lite_model is not None:
+                self.models.put((model_type, ticker), (time.time(), lite_model, scaler))
+        prediction = (ticker, (predicted_price - current_price) / current_price, current_price, predicted_price)
+        self.results.put((model_type, ticker), (last_bar, prediction))
+        return prediction
+
+    def predict(self, model_type, ticker):
+        """同一股票、同一模型的並發請求合併為一次計算"""
+        return self.flights.do(("predict", model_type, ticker), lambda: self._predict(model_type, ticker))
+
+    def score_ticker(self, ticker, models=None):
+        """:return: ({模型名稱: prediction}, {模型名稱: 錯誤訊息})"""
+        predictions, errors = {}, {}
+        for model_type in self.enabled_models(models):
+            try:
+                predictions[model_type] = self.predict(model_type, ticker)
+            except Exception as e:
+                errors[model_type] = str(e)
+        return predictions, errors
+
+    def index_members(self, index_name):
+        cached = self.members.get(index_name)
+        if cached is None or time.time() - cached[0] >= MEMBERS_TTL_SECONDS:
+            stock_list = app.plan_universe([index_name])[1].get(index_name)
+            if stock_list is None:
+                raise LookupError(f"未知的指數: {index_name}")
+            cached = self.members[index_name] = (time.time(), stock_list)
+        return cached[1]
+
+    def score_index(self, index_name, models=None, n=10):
+        """返回與 app.build_stock_predictions 相同格式的前 n 名與後 n 名"""
+        stock_list = self.index_members(index_name)
+        self.prefetch(stock_list)
+        trackers = {model: app.TopBottomTracker(n) for model in self.enabled_models(models)}
+        for order, ticker in enumerate(stock_list):
+            predictions, _ = self.score_ticker(ticker, list(trackers))
+            for model_type, prediction in predictions.items():
+                trackers[model_type].add(prediction, order)
+        return app.build_stock_predictions(trackers)
+
+    def stats(self):
+        return {"models": self.models.stats(), "data": self.data.stats(), "results": self.results.stats(),
+                "coalesced": self.flights.coalesced, "spans": app.metrics.summary()}
+
+
+def flush_metrics():
+    with _flush_lock:
+        if len(app.metrics.spans) < METRICS_FLUSH_SPANS:
+            return
+        if app.metrics_file:
+            app.metrics.write(app.metrics_file)
+        app.metrics.drain()
+
+
+_flush_lock = threading.Lock()
+
+
+def _prediction_json(prediction):
+    ticker, potential, current_price, predicted_price = prediction
+    return {"ticker": ticker, "potential": potential, "current_price": current_price, "predicted_price": predicted_price}
+
+
+def make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status, body):
+            payload = json.dumps(body, ensure_ascii=False, default=str).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            models = [model for model in query.get("models", "").split(",") if model] or None
+            start = time.perf_counter()
+            try:
+                if url.path == "/health":
+                    body = {"status": "ok"}
+                elif url.path == "/stats":
+                    body = service.stats()
+                elif url.path == "/predict" and query.get("ticker"):
+                    predictions, errors = service.score_ticker(query["ticker"], models)
+                    body = {"ticker": query["ticker"], "errors": errors,
+                            "predictions": {model: _prediction_json(p) for model, p in predictions.items()}}
+                elif url.path == "/index" and query.get("name"):
+                    top = query.get("top", "10")
+                    if not top.isdigit() or int(top) < 1:
+                        self._send(400, {"error": f"top 必須是正整數: {top!r}"})
+                        return
+                    stock_predictions = service.score_index(query["name"], models, int(top))
+                    body = {"index": query["name"], "predictions": {
+                        section: [_prediction_json(p) for p in predictions]
+                        for section, predictions in stock_predictions.items()}}
+                else:
+                    self._send(404, {"error": "可用的路徑: /predict?ticker=、/index?name=、/stats、/health"})
+                    return
+            except LookupError as e:
+                self._send(404, {"error": str(e)})
+                return
+            except Exception as e:
+                self._send(500, {"error": str(e)})
+                return
+            body["seconds"] = round(time.perf_counter() - start, 4)
+            self._send(200, body)
+            flush_metrics()
+
+        def log_message(self, format, *args):
+            print(f"{self.address_string()} {format % args}", file=sys.stderr)
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="常駐的預測服務")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--period", default="3mo", help="LSTM / Prophet 使用的數據區間")
+    parser.add_argument("--cache-size", type=int, default=500, help="最多保留在記憶體中的模型數")
+    parser.add_argument("--data-ttl", type=float, default=300, help="價格數據的快取秒數")
+    parser.add_argument("--model-ttl", type=float, default=3600, help="模型的快取秒數，過期後重新從檢查點載入")
+    parser.add_argument("--preload", help="啟動後在背景預先載入這些指數（逗號分隔）的模型")
+    args = parser.parse_args()
+
+    errors = app.validate_config()
+    if errors:
+        for error in errors:
+            print(f"⚠️ 設定錯誤: {error}")
+        return 1
+    if args.cache_size < 1:
+        parser.error("--cache-size 必須大於 0")
+
+    service = ScoringService(args.period, args.cache_size, args.data_ttl, args.model_ttl)
+    if args.preload:
+        def preload():
+            for index_name in args.preload.split(","):
+                try:
+                    service.score_index(index_name)
+                    print(f"已預先載入: {index_name}", file=sys.stderr)
+                except Exception as e:
+                    print(f"預先載入失敗: {index_name}, 錯誤: {str(e)}", file=sys.stderr)
+        threading.Thread(target=preload, daemon=True).start()
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+    print(f"預測服務已啟動: http://{args.host}:{args.port}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("已停止")
+    finally:
+        server.server_close()
+        if app.metrics_file:
+            app.metrics.write(app.metrics_file)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())